@@ -1,35 +1,131 @@
 import os
+import random
 import numpy as np
-import pickle
 from torch.utils import data
 
+from pack_npy import load_store
+
+
+def crop(audio, n_frames, input_length, random_start=True):
+    """Copies a window of input_length frames from the first n_frames of a (n_bands, frames) array, which can be
+    memory-mapped so that only the window is read. Tracks shorter than the window are repeated to fill it, empty ones
+    give a window of zeros."""
+    n_frames = min(int(n_frames), audio.shape[1])
+    if n_frames == 0:
+        return np.zeros((audio.shape[0], input_length), dtype=audio.dtype)
+    if n_frames <= input_length:
+        return np.pad(np.array(audio[:, :n_frames]), ((0, 0), (0, input_length - n_frames)), mode='wrap')
+    if random_start:
+        start = random.randint(0, n_frames - input_length)
+    else:
+        start = (n_frames - input_length) // 2
+    return np.array(audio[:, start:start + input_length])
+
+
+def get_windows(audio, input_length, hop_length):
+    """Overlapping windows of input_length frames every hop_length frames of a (n_bands, frames) array, the last one
+    ending at the end of the array. Arrays shorter than a window give a single one, repeated to fill it."""
+    n_frames = audio.shape[1]
+    starts = list(range(0, max(n_frames - input_length, 0) + 1, hop_length))
+    if n_frames > input_length and starts[-1] != n_frames - input_length:
+        starts.append(n_frames - input_length)
+    return [crop(audio[:, start:], input_length, input_length, False) for start in starts]
+
 
 class AudioFolder(data.Dataset):
-    def __init__(self, root, subset, tr_val='train', split=0):
+    """Mel-spectrograms and tags of a split. If input_length is given, every item is a window of that many frames
+    (random for training, centered otherwise) instead of the whole array, so that full-length spectrograms can be
+    batched."""
+    def __init__(self, root, subset, tr_val='train', split=0, input_length=None):
         self.trval = tr_val
         self.root = root
-        fn = '../../data/splits/split-%d/%s_%s_dict.pickle' % (split, subset, tr_val)
-        self.get_dictionary(fn)
+        self.input_length = input_length
+        fn = '../../data/splits/split-%d/%s_%s_manifest.npz' % (split, subset, tr_val)
+        self.get_manifest(fn)
 
     def __getitem__(self, index):
-        fn = os.path.join(self.root, 'npy', self.dictionary[index]['path'][:-3]+'npy')
-        audio = np.array(np.load(fn))
-        tags = self.dictionary[index]['tags']
-        return audio.astype('float32'), tags.astype('float32'), self.dictionary[index]['path']
+        fn = os.path.join(self.root, 'npy', self.paths[index][:-3]+'npy')
+        if self.input_length is None:
+            audio = np.array(np.load(fn))
+        else:
+            # Only the window is read from the memory-mapped file, get_npy.py stored its number of frames as duration
+            audio = crop(np.load(fn, mmap_mode='r'), self.durations[index], self.input_length,
+                         self.trval == 'train')
+        return audio.astype('float32'), self.get_tags(index), str(self.paths[index])
+
+    def get_manifest(self, fn):
+        """Reads the manifest written by get_npy.py (NPZ file with path, duration, packed tags and tag_list arrays)"""
+        with np.load(fn, allow_pickle=False) as manifest:
+            self.paths = manifest['path']
+            self.durations = manifest['duration']
+            self.tags = manifest['tags']
+            self.n_tags = len(manifest['tag_list'])
 
-    def get_dictionary(self, fn):
-        with open(fn, 'rb') as pf:
-            dictionary = pickle.load(pf)
-        self.dictionary = dictionary
+    def get_tags(self, index):
+        return np.unpackbits(self.tags[index], count=self.n_tags).astype('float32')
 
     def __len__(self):
-        return len(self.dictionary)
+        return len(self.paths)
 
 
-def get_audio_loader(root, subset, batch_size, tr_val='train', split=0, num_workers=0):
-    data_loader = data.DataLoader(dataset=AudioFolder(root, subset, tr_val, split),
+class ShardedAudioFolder(AudioFolder):
+    """AudioFolder reading the mel-spectrograms from the shards written by pack_npy.py.
+
+    Tracks are served as views of the memory-mapped shards, without reading or copying them (float16 shards are
+    converted to float32). Shards are mapped lazily, so that every DataLoader worker maps its own.
+    """
+    def __init__(self, root, subset, tr_val='train', split=0, input_length=None, store=None):
+        super(ShardedAudioFolder, self).__init__(root, subset, tr_val, split, input_length)
+        self.store = store
+        self.shards = None
+        index, self.info, _ = load_store(store)
+        positions = {path: i for i, path in enumerate(index['path'])}
+        missing = [path for path in self.paths if path not in positions]
+        if missing:
+            raise ValueError('{} tracks are not in {}, e.g. {}'.format(len(missing), store, missing[0]))
+        rows = np.array([positions[path] for path in self.paths], dtype=np.int64)
+        self.shard = index['shard'][rows]
+        self.offset = index['offset'][rows]
+        self.n_frames = index['n_frames'][rows]
+
+    def __getitem__(self, index):
+        if self.shards is None:
+            # Copy-on-write mapping gives writable arrays (as expected by torch) while nothing is ever written
+            self.shards = [np.load(os.path.join(self.store, fn), mmap_mode='c') for fn in self.info['shards']]
+        n_bands = self.info['n_bands']
+        offset = self.offset[index]
+        audio = self.shards[self.shard[index]][offset:offset + n_bands * self.n_frames[index]]
+        audio = audio.reshape(n_bands, -1)
+        if self.input_length is not None:
+            audio = crop(audio, self.n_frames[index], self.input_length, self.trval == 'train')
+        if audio.dtype != np.float32:
+            audio = audio.astype('float32')
+        return audio, self.get_tags(index), str(self.paths[index])
+
+
+def get_audio_loader(root, subset, batch_size, tr_val='train', split=0, num_workers=0, store=None,
+                     input_length=None, shuffle=True, pin_memory=False, persistent_workers=False, prefetch_factor=2):
+    if store is None:
+        dataset = AudioFolder(root, subset, tr_val, split, input_length)
+    else:
+        dataset = ShardedAudioFolder(root, subset, tr_val, split, input_length, store)
+    # Worker settings are only accepted by DataLoader when there are workers
+    worker_args = {}
+    if num_workers > 0:
+        worker_args = {'persistent_workers': persistent_workers, 'prefetch_factor': prefetch_factor}
+    data_loader = data.DataLoader(dataset=dataset,
                                   batch_size=batch_size,
-                                  shuffle=True,
-                                  num_workers=num_workers)
+                                  shuffle=shuffle,
+                                  num_workers=num_workers,
+                                  pin_memory=pin_memory,
+                                  **worker_args)
     return data_loader
 
+
+def get_track_loader(root, subset, tr_val='test', split=0, num_workers=0, store=None):
+    """Loader of whole spectrograms one track at a time, in the order of the split, for sliding window inference"""
+    if store is None:
+        dataset = AudioFolder(root, subset, tr_val, split)
+    else:
+        dataset = ShardedAudioFolder(root, subset, tr_val, split, store=store)
+    return data.DataLoader(dataset=dataset, batch_size=None, shuffle=False, num_workers=num_workers)
@@ -0,0 +1,93 @@
+import os
+import copy
+import time
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from solver import Solver
+from data_loader import get_audio_loader
+
+
+def export(model, input_length=1366, quantize=False, channels_last=False):
+    """TorchScript version of the model for CPU inference, with batch normalization folded into the convolutions"""
+    model = copy.deepcopy(model).eval()
+    if quantize:
+        # Dynamic int8 quantization only has kernels for the dense layer, convolutions stay in float
+        model = torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    with torch.no_grad():
+        scripted = torch.jit.trace(model, torch.zeros(1, 96, input_length))
+    return torch.jit.optimize_for_inference(torch.jit.freeze(scripted))
+
+
+def predict(model, data_loader):
+    """Predictions, ground truth and time of every batch of the data loader"""
+    prd_array = []
+    gt_array = []
+    latencies = []
+    with torch.no_grad():
+        for x, y, _ in data_loader:
+            start = time.time()
+            out = model(x)
+            latencies.append(time.time() - start)
+            prd_array.append(out.numpy())
+            gt_array.append(y.numpy())
+    return np.concatenate(prd_array), np.concatenate(gt_array), np.array(latencies)
+
+
+def benchmark(solver, models, data_loader):
+    for name, model in models:
+        # the first batches of a TorchScript model are slower (profiling and optimization), two are run before timing
+        for _, (x, _, _) in zip(range(2), data_loader):
+            with torch.no_grad():
+                model(x)
+        prd_array, gt_array, latencies = predict(model, data_loader)
+        print('%s: %.1f ms/batch (median), %.1f tracks/s' %
+              (name, np.median(latencies) * 1000, len(prd_array) / latencies.sum()))
+        solver.get_auc(prd_array, gt_array)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports the trained model to TorchScript for CPU inference, '
+                                                 'optionally quantized, and compares it with the float model',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--model_save_path', type=str, default='./models', help='directory with best_model.pth')
+    parser.add_argument('--output', type=str, default=None,
+                        help='TorchScript file (default: best_model.pt in model_save_path)')
+    parser.add_argument('--subset', type=str, default='all')
+    parser.add_argument('--split', type=int, default=0)
+    parser.add_argument('--input_length', type=int, default=1366, help='frames of the input of the model')
+    parser.add_argument('--quantize', action='store_true', help='dynamic int8 quantization of the dense layer')
+    parser.add_argument('--channels_last', action='store_true', help='channels last memory format for convolutions')
+    parser.add_argument('--threads', type=int, default=None, help='number of CPU threads (default: PyTorch default)')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='compare latency and ROC-AUC of the float and exported models on the test set')
+    parser.add_argument('--audio_path', type=str, default='/home')
+    parser.add_argument('--store', type=str, default=None)
+    parser.add_argument('--batch_size', type=int, default=32)
+    config = parser.parse_args()
+
+    if config.threads is not None:
+        torch.set_num_threads(config.threads)
+    print('%d threads' % torch.get_num_threads())
+
+    # The model is loaded and exported on CPU even if there is a GPU
+    solver = Solver(None, None, config)
+    solver.is_cuda = False
+    solver.model.cpu()
+    solver.load(solver.model_fn)
+    solver.model.eval()
+
+    scripted = export(solver.model, config.input_length, config.quantize, config.channels_last)
+    output = config.output or os.path.join(config.model_save_path, 'best_model.pt')
+    scripted.save(output)
+    print('Saved %s' % output)
+
+    if config.benchmark:
+        data_loader = get_audio_loader(config.audio_path, config.subset, config.batch_size, tr_val='test',
+                                       split=config.split, store=config.store, input_length=config.input_length)
+        benchmark(solver, [('float', solver.model), ('torchscript', scripted)], data_loader)
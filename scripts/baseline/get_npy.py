@@ -1,19 +1,15 @@
 import os
-import csv
-import pickle
+import sys
 import numpy as np
 import fire
-from collections import Counter
 
-class Split:
-    def read_tsv(self, fn):
-        r = []
-        with open(fn) as tsv:
-            reader = csv.reader(tsv, delimiter='\t')
-            for row in reader:
-                r.append(row)
-        return r[1:]
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import commons
+
+MAX_FRAMES = np.iinfo(np.uint16).max
+
 
+class Split:
     def get_tag_list(self, option):
         if option == 'top50tags':
             tag_list = np.load('tag_list_50.npy')
@@ -27,40 +23,40 @@ class Split:
                 tag_list = tag_list[127:]
         return list(tag_list)
 
+    def get_npy_files(self):
+        """Set of all NPY files (relative to the npy path), listed once instead of checking every track"""
+        npy_files = set()
+        for dirpath, _, files in os.walk(self.npy_path):
+            for name in files:
+                npy_files.add(os.path.relpath(os.path.join(dirpath, name), self.npy_path))
+        return npy_files
+
     def get_npy_array(self, path, tag_list, option, type_='train'):
-        if option=='all':
-            tsv_fn = os.path.join(path, 'autotagging-%s.tsv'%type_)
+        """Writes the manifest of a split part: paths, number of frames (uint16, saturated for tracks over ~23
+        minutes) and tags as a bit matrix packed along tags, for tracks with tags of the option and a spectrogram"""
+        if option == 'all':
+            tsv_fn = os.path.join(path, 'autotagging-%s.tsv' % type_)
         else:
-            tsv_fn = os.path.join(path, 'autotagging_%s-%s.tsv'%(option, type_))
-        rows = self.read_tsv(tsv_fn)
-        dictionary = {}
-        i = 0
-        for row in rows:
-            temp_dict = {}
-            temp_dict['path'] = row[3]
-            temp_dict['duration'] = (float(row[4]) * 12000 - 512) // 256
-            if option == 'all':
-                temp_dict['tags'] = np.zeros(183)
-            elif option == 'genre':
-                temp_dict['tags'] = np.zeros(87)
-            elif option == 'instrument':
-                temp_dict['tags'] = np.zeros(40)
-            elif option == 'moodtheme':
-                temp_dict['tags'] = np.zeros(56)
-            elif option == 'top50tags':
-                temp_dict['tags'] = np.zeros(50)
-            tags = row[5:]
-            for tag in tags:
-                try:
-                    temp_dict['tags'][tag_list.index(tag)] = 1
-                except:
-                    continue
-            if temp_dict['tags'].sum() > 0 and os.path.exists(os.path.join(self.npy_path, row[3][:-3])+'npy'):
-                dictionary[i] = temp_dict
-                i += 1
-        dict_fn = os.path.join(path, '%s_%s_dict.pickle'%(option, type_))
-        with open(dict_fn, 'wb') as pf:
-            pickle.dump(dictionary, pf)
+            tsv_fn = os.path.join(path, 'autotagging_%s-%s.tsv' % (option, type_))
+        metadata = commons.read_metadata(tsv_fn)
+
+        # Columns of the tags of the file in tag_list (-1 if not in it), looked up once per tag
+        tag_index = {tag: i for i, tag in enumerate(tag_list)}
+        columns = np.array([tag_index.get(tag, -1) for tag in metadata.tags], dtype=np.int64)[metadata.indices]
+        rows = np.repeat(np.arange(len(metadata)), np.diff(metadata.indptr))
+        labels = np.zeros((len(metadata), len(tag_list)), dtype=bool)
+        labels[rows[columns >= 0], columns[columns >= 0]] = True
+
+        exists = np.array([track_path[:-3] + 'npy' in self.npy_files for track_path in metadata.paths], dtype=bool)
+        selected = labels.any(axis=1) & exists
+        durations = (metadata.durations[selected] * 12000 - 512) // 256
+
+        manifest_fn = os.path.join(path, '%s_%s_manifest.npz' % (option, type_))
+        np.savez(manifest_fn,
+                 path=np.array(list(metadata.paths[selected]), dtype=str),
+                 duration=np.clip(durations, 0, MAX_FRAMES).astype(np.uint16),
+                 tags=np.packbits(labels[selected], axis=1),
+                 tag_list=np.array(tag_list, dtype=str))
 
     def run_iter(self, split, option='all'):
         tag_list = self.get_tag_list(option)
@@ -71,6 +67,7 @@ class Split:
 
     def run(self, path):
         self.npy_path = path
+        self.npy_files = self.get_npy_files()
         for i in range(5):
             self.run_iter(i, 'all')
             self.run_iter(i, 'genre')
@@ -2,7 +2,14 @@ import os
 import argparse
 
 from solver import Solver
-from data_loader import get_audio_loader
+from data_loader import get_audio_loader, get_track_loader
+
+
+def get_loader_args(config):
+    return {'num_workers': config.num_workers,
+            'pin_memory': config.pin_memory,
+            'persistent_workers': config.persistent_workers,
+            'prefetch_factor': config.prefetch_factor}
 
 
 def main(config):
@@ -17,22 +24,45 @@ def main(config):
                                        config.subset,
                                         config.batch_size,
                                         tr_val = 'train',
-                                        split = config.split)
+                                        split = config.split,
+                                        store = config.store,
+                                        input_length = config.input_length,
+                                        **get_loader_args(config))
         valid_loader = get_audio_loader(config.audio_path,
                                         config.subset,
                                         config.batch_size,
                                         tr_val='validation',
-                                        split = config.split)
+                                        split = config.split,
+                                        store = config.store,
+                                        input_length = config.input_length,
+                                        shuffle = False,
+                                        **get_loader_args(config))
         solver = Solver(data_loader, valid_loader, config)
 
         solver.train()
 
+    elif config.mode == 'TEST' and config.aggregate is not None:
+        data_loader = get_track_loader(config.audio_path,
+                                       config.subset,
+                                       tr_val = 'test',
+                                       split = config.split,
+                                       num_workers = config.num_workers,
+                                       store = config.store)
+
+        solver = Solver(data_loader, None, config)
+
+        solver.test_windows(config.input_length or 1366, config.hop_length, config.aggregate)
+
     elif config.mode == 'TEST':
         data_loader = get_audio_loader(config.audio_path,
                                        config.subset,
                                         config.batch_size,
                                         tr_val = 'test',
-                                        split = config.split)
+                                        split = config.split,
+                                        store = config.store,
+                                        input_length = config.input_length,
+                                        shuffle = False,
+                                        **get_loader_args(config))
 
         solver = Solver(data_loader, None, config)
 
@@ -48,6 +78,22 @@ if __name__ == '__main__':
     parser.add_argument('--audio_path', type=str, default='/home')
     parser.add_argument('--split', type=int, default=0)
     parser.add_argument('--subset', type=str, default='all')
+    parser.add_argument('--input_length', type=int, default=None,
+                        help='number of frames of the window read from every spectrogram (e.g. 1366 for 29.1s), '
+                             'needed to batch full-length spectrograms')
+    parser.add_argument('--aggregate', type=str, default=None, choices=['mean', 'max'],
+                        help='test on overlapping windows of input_length frames (default 1366) over whole '
+                             'spectrograms, aggregating the predictions of every track')
+    parser.add_argument('--hop_length', type=int, default=683, help='frames between windows with --aggregate')
+    parser.add_argument('--num_workers', type=int, default=0, help='data loading processes (0: main process)')
+    parser.add_argument('--pin_memory', action='store_true', help='copy batches to pinned memory for faster GPU '
+                                                                  'transfers')
+    parser.add_argument('--persistent_workers', action='store_true',
+                        help='keep data loading processes between epochs (with num_workers > 0)')
+    parser.add_argument('--prefetch_factor', type=int, default=2,
+                        help='batches loaded in advance by every process (with num_workers > 0)')
+    parser.add_argument('--store', type=str, default=None,
+                        help='directory of mel-spectrogram shards written by pack_npy.py, instead of audio_path/npy')
 
     config = parser.parse_args()
 
@@ -38,6 +38,10 @@ class CNN(nn.Module):
         self.dense = nn.Linear(64, num_class)
         self.dropout = nn.Dropout(0.5)
 
+        # activations (without parameters, shared by all layers)
+        self.elu = nn.ELU()
+        self.sigmoid = nn.Sigmoid()
+
     def forward(self, x):
         x = x.unsqueeze(1)
 
@@ -45,23 +49,23 @@ class CNN(nn.Module):
         x = self.bn_init(x)
 
         # layer 1
-        x = self.mp_1(nn.ELU()(self.bn_1(self.conv_1(x))))
+        x = self.mp_1(self.elu(self.bn_1(self.conv_1(x))))
 
         # layer 2
-        x = self.mp_2(nn.ELU()(self.bn_2(self.conv_2(x))))
+        x = self.mp_2(self.elu(self.bn_2(self.conv_2(x))))
 
         # layer 3
-        x = self.mp_3(nn.ELU()(self.bn_3(self.conv_3(x))))
+        x = self.mp_3(self.elu(self.bn_3(self.conv_3(x))))
 
         # layer 4
-        x = self.mp_4(nn.ELU()(self.bn_4(self.conv_4(x))))
+        x = self.mp_4(self.elu(self.bn_4(self.conv_4(x))))
 
         # layer 5
-        x = self.mp_5(nn.ELU()(self.bn_5(self.conv_5(x))))
+        x = self.mp_5(self.elu(self.bn_5(self.conv_5(x))))
 
         # classifier
         x = x.view(x.size(0), -1)
         x = self.dropout(x)
-        logit = nn.Sigmoid()(self.dense(x))
+        logit = self.sigmoid(self.dense(x))
 
         return logit
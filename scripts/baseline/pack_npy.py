@@ -0,0 +1,96 @@
+import os
+import json
+import argparse
+import numpy as np
+
+INDEX_FILE = 'index.npz'
+INFO_FILE = 'info.json'
+SHARD_FILE = 'shard-%05d.npy'
+
+
+def find_npy(root):
+    """Paths of all NPY files under root/npy, relative to it and with the audio extension used in the manifests"""
+    npy_dir = os.path.join(root, 'npy')
+    paths = []
+    for dirpath, _, files in os.walk(npy_dir):
+        for name in files:
+            if name.endswith('.npy'):
+                paths.append(os.path.relpath(os.path.join(dirpath, name), npy_dir)[:-3] + 'mp3')
+    return sorted(paths)
+
+
+def pack(root, output_dir, dtype='float32', shard_size=2 * 1024 ** 3):
+    """Packs the mel-spectrograms of root/npy into a few large shards.
+
+    Every shard is a flat NPY array with the (n_bands, n_frames) arrays of its tracks stored one after another in C
+    order, so a track is a contiguous slice of a shard that can be reshaped without copying. The index stores the
+    path, shard, offset and number of frames of every track.
+    """
+    paths = find_npy(root)
+    itemsize = np.dtype(dtype).itemsize
+
+    # Shapes are read from the NPY headers only, to know the size of every shard before writing it
+    shapes = [np.load(os.path.join(root, 'npy', path[:-3] + 'npy'), mmap_mode='r').shape for path in paths]
+    n_bands = shapes[0][0] if shapes else 0
+    for path, shape in zip(paths, shapes):
+        if len(shape) != 2 or shape[0] != n_bands:
+            raise ValueError('{} has shape {}, expected ({}, n_frames)'.format(path, shape, n_bands))
+
+    n_frames = np.array([shape[1] for shape in shapes], dtype=np.int64)
+    shards = np.zeros(len(paths), dtype=np.int32)
+    offsets = np.zeros(len(paths), dtype=np.int64)
+    shard, offset = 0, 0
+    for i, frames in enumerate(n_frames):
+        size = n_bands * frames
+        if offset > 0 and (offset + size) * itemsize > shard_size:
+            shard, offset = shard + 1, 0
+        shards[i], offsets[i] = shard, offset
+        offset += size
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    shard_files = []
+    for shard in np.unique(shards):
+        selected = np.flatnonzero(shards == shard)
+        last = selected[-1]
+        shard_file = SHARD_FILE % shard
+        array = np.lib.format.open_memmap(os.path.join(output_dir, shard_file), mode='w+', dtype=dtype,
+                                          shape=(int(offsets[last] + n_bands * n_frames[last]),))
+        for i in selected:
+            audio = np.load(os.path.join(root, 'npy', paths[i][:-3] + 'npy'))
+            array[offsets[i]:offsets[i] + audio.size] = audio.ravel()
+        array.flush()
+        del array
+        shard_files.append(shard_file)
+        print('{}: {} tracks'.format(shard_file, len(selected)))
+
+    # Paths are stored as a unicode array so that the index can be loaded without pickle
+    np.savez(os.path.join(output_dir, INDEX_FILE), path=np.array(paths, dtype=str), shard=shards, offset=offsets,
+             n_frames=n_frames)
+    with open(os.path.join(output_dir, INFO_FILE), 'w') as fp:
+        json.dump({'dtype': np.dtype(dtype).name, 'n_bands': int(n_bands), 'shards': shard_files}, fp)
+    print('Packed {} tracks into {} shards'.format(len(paths), len(shard_files)))
+
+
+def load_store(store_dir):
+    """Returns the index arrays, the info and the memory-mapped shards of a packed store"""
+    with np.load(os.path.join(store_dir, INDEX_FILE), allow_pickle=False) as npz:
+        index = {name: npz[name] for name in npz.files}
+    with open(os.path.join(store_dir, INFO_FILE)) as fp:
+        info = json.load(fp)
+    shards = [np.load(os.path.join(store_dir, shard_file), mmap_mode='r') for shard_file in info['shards']]
+    return index, info, shards
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Packs per-track mel-spectrograms (root/npy) into a few large shard '
+                                                 'files that are read memory-mapped by ShardedAudioFolder',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('root', help='root directory with the npy folder (same as --audio_path of main.py)')
+    parser.add_argument('output_dir', help='directory for the shards and their index')
+    parser.add_argument('--dtype', choices=['float32', 'float16'], default='float32',
+                        help='storage type, float16 halves the size of the shards')
+    parser.add_argument('--shard-size', type=int, default=2 * 1024 ** 3, help='maximum size of a shard in bytes')
+    args = parser.parse_args()
+
+    pack(args.root, args.output_dir, args.dtype, args.shard_size)
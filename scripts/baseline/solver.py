@@ -12,6 +12,7 @@ import torch
 import torch.nn as nn
 
 from model import CNN
+from data_loader import get_windows
 
 
 class Solver(object):
@@ -50,15 +51,14 @@ class Solver(object):
 
     def build_model(self):
         # model and optimizer
-        model = CNN(num_class=self.num_class)
+        self.model = CNN(num_class=self.num_class)
 
         if self.is_cuda:
-            self.model = model
             self.model.cuda()
         self.optimizer = torch.optim.Adam(self.model.parameters(), self.lr)
 
     def load(self, filename):
-        S = torch.load(filename)
+        S = torch.load(filename, map_location=None if self.is_cuda else 'cpu')
         self.model.load_state_dict(S)
 
     def save(self, filename):
@@ -67,7 +67,7 @@ class Solver(object):
 
     def to_var(self, x):
         if self.is_cuda:
-            x = x.cuda()
+            x = x.cuda(non_blocking=True)
         return x
 
     def train(self):
@@ -82,8 +82,14 @@ class Solver(object):
             # train
             self.model.train()
             ctr = 0
+            # time spent waiting for the data loader and computing, to tell if training is I/O bound
+            load_time = 0
+            compute_time = 0
+            batch_t = time.time()
             for x, y, _ in self.data_loader:
                 ctr += 1
+                compute_t = time.time()
+                load_time += compute_t - batch_t
 
                 # variables to cuda
                 x = self.to_var(x)
@@ -97,13 +103,21 @@ class Solver(object):
                 self.optimizer.zero_grad()
                 loss.backward()
                 self.optimizer.step()
+                if self.is_cuda:
+                    torch.cuda.synchronize()
+                batch_t = time.time()
+                compute_time += batch_t - compute_t
 
                 # print log
                 if (ctr) % self.log_step == 0:
-                    print("[%s] Epoch [%d/%d] Iter [%d/%d] train loss: %.4f Elapsed: %s" %
+                    print("[%s] Epoch [%d/%d] Iter [%d/%d] train loss: %.4f Elapsed: %s Load: %.1fs Compute: %.1fs" %
                             (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
                             epoch+1, self.n_epochs, ctr, len(self.data_loader), loss.item(),
-                            datetime.timedelta(seconds=time.time()-start_t)))
+                            datetime.timedelta(seconds=time.time()-start_t), load_time, compute_time))
+
+            print("[%s] Epoch [%d/%d] data loading: %.1fs, compute: %.1fs (%.0f%% of the time waiting for data)" %
+                    (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), epoch+1, self.n_epochs,
+                    load_time, compute_time, 100 * load_time / max(load_time + compute_time, 1e-6)))
 
             # validation
             roc_auc, _ = self._validation(start_t, epoch)
@@ -127,7 +141,7 @@ class Solver(object):
         ctr = 0
         self.model.eval()
         reconst_loss = nn.BCELoss()
-        for x, y in self.valid_loader:
+        for x, y, _ in self.valid_loader:
             ctr += 1
 
             # variables to cuda
@@ -245,6 +259,9 @@ class Solver(object):
             for song in fn:
                 song_array.append(song)
 
+        self.save_predictions(prd_array, gt_array, song_array)
+
+    def save_predictions(self, prd_array, gt_array, song_array):
         # get auc
         roc_auc, pr_auc, roc_auc_all, pr_auc_all = self.get_auc(prd_array, gt_array)
 
@@ -253,3 +270,57 @@ class Solver(object):
         np.save(open(self.pr_auc_fn, 'wb'), pr_auc_all)
         np.save(open('prd.npy', 'wb'), prd_array)
         np.save(open('song_list.npy', 'wb'), song_array)
+
+    def test_windows(self, input_length=1366, hop_length=683, aggregate='mean'):
+        """Tests on whole spectrograms, one track at a time from the data loader (see get_track_loader). Overlapping
+        windows of input_length frames are predicted in batches mixing tracks, and aggregated per track by mean or
+        max."""
+        start_t = time.time()
+        self.load(self.model_fn)
+        self.model.eval()
+
+        n_tracks = len(self.data_loader)
+        prd_sum = np.zeros((n_tracks, self.num_class), dtype=np.float32)
+        prd_max = np.zeros((n_tracks, self.num_class), dtype=np.float32)
+        n_windows = np.zeros(n_tracks, dtype=np.int64)
+        gt_array = []   # ground truth
+        song_array = [] # song array
+        windows = []
+        window_tracks = []
+
+        def predict():
+            x = self.to_var(torch.from_numpy(np.stack(windows)))
+            out = self.model(x).detach().cpu().numpy()
+            tracks = np.array(window_tracks)
+            np.add.at(prd_sum, tracks, out)
+            np.maximum.at(prd_max, tracks, out)
+            np.add.at(n_windows, tracks, 1)
+            del windows[:], window_tracks[:]
+
+        with torch.no_grad():
+            for track, (x, y, fn) in enumerate(self.data_loader):
+                gt_array.append(y.numpy())
+                song_array.append(fn)
+                for window in get_windows(x.numpy(), input_length, hop_length):
+                    windows.append(window)
+                    window_tracks.append(track)
+                    if len(windows) == self.batch_size:
+                        predict()
+
+                if (track + 1) % (self.log_step * self.batch_size) == 0:
+                    elapsed = time.time() - start_t
+                    print("[%s] Track [%d/%d] %.1f tracks/s Elapsed: %s" %
+                            (datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                            track + 1, n_tracks, (track + 1) / elapsed, datetime.timedelta(seconds=elapsed)))
+            if windows:
+                predict()
+
+        elapsed = time.time() - start_t
+        print('Predicted %d tracks (%d windows) in %s: %.1f tracks/s' %
+              (n_tracks, n_windows.sum(), datetime.timedelta(seconds=elapsed), n_tracks / elapsed))
+
+        if aggregate == 'mean':
+            prd_array = prd_sum / n_windows[:, None]
+        else:
+            prd_array = prd_max
+        self.save_predictions(prd_array, gt_array, song_array)
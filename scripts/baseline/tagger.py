@@ -0,0 +1,280 @@
+import os
+import sys
+import json
+import queue
+import argparse
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from model import CNN
+from data_loader import get_windows
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+N_BANDS = 96
+
+SUBSETS = {'all': slice(None), 'genre': slice(None, 87), 'instrument': slice(87, 127), 'moodtheme': slice(127, None),
+           'top50tags': slice(None)}
+
+REQUEST_DESCRIPTION = '''Requests are JSON objects with either an audio "path" (mel-spectrograms are computed as by
+melspectrograms.py), a "path" of an NPY mel-spectrogram, or a "mel" array (n_bands x frames), and an optional "id":
+  {"id": 1, "path": "audio/14/214.mp3"}
+Responses have the same "id" and the probability of every tag, or an "error":
+  {"id": 1, "tags": {"genre---rock": 0.81, ...}}
+With --port, requests are POSTed to the server (a single object or a list), otherwise they are read from stdin, one
+per line, and responses are written to stdout in the same order.'''
+
+
+def get_tag_list(subset):
+    """Tags predicted by the model of a subset, in the order of its outputs"""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    tag_list = np.load(os.path.join(directory, 'tag_list_50.npy' if subset == 'top50tags' else 'tag_list.npy'))
+    return [str(tag) for tag in tag_list[SUBSETS[subset]]]
+
+
+def get_id(request):
+    return request.get('id') if isinstance(request, dict) else None
+
+
+class Tagger:
+    """Trained model loaded once, tagging batches of tracks"""
+
+    def __init__(self, model_fn, subset='all', batch_size=32, input_length=1366, hop_length=683, aggregate='mean',
+                 full_audio=False, backend='essentia'):
+        self.tag_list = get_tag_list(subset)
+        self.batch_size = batch_size
+        self.input_length = input_length
+        self.hop_length = hop_length
+        self.aggregate = aggregate
+        self.full_audio = full_audio
+        self.backend = backend
+        self.extractor = None
+
+        self.is_cuda = torch.cuda.is_available()
+        if model_fn.endswith('.pt'):
+            # TorchScript model written by export.py, for CPU inference
+            self.is_cuda = False
+            self.model = torch.jit.load(model_fn, map_location='cpu')
+        else:
+            self.model = CNN(num_class=len(self.tag_list))
+            self.model.load_state_dict(torch.load(model_fn, map_location='cuda' if self.is_cuda else 'cpu'))
+            if self.is_cuda:
+                self.model.cuda()
+        self.model.eval()
+
+    def get_mel(self, request):
+        """Mel-spectrogram of a request, checked so that a bad request cannot fail the batch it is in"""
+        if not isinstance(request, dict):
+            raise TypeError('request must be a JSON object, not {}'.format(type(request).__name__))
+        if 'mel' in request:
+            mel = np.array(request['mel'], dtype=np.float32)
+        elif request['path'].endswith('.npy'):
+            mel = np.load(request['path'])
+        else:
+            mel = self.load_audio(request['path'])
+
+        if mel.ndim != 2 or mel.shape[0] != N_BANDS:
+            raise ValueError('mel-spectrogram must have shape ({}, frames), not {}'.format(N_BANDS, mel.shape))
+        if not np.issubdtype(mel.dtype, np.floating) or not np.isfinite(mel).all():
+            raise ValueError('mel-spectrogram must have finite float values')
+        return mel
+
+    def load_audio(self, path):
+        # Only needed (and imported) when audio is given
+        import melspectrograms
+        if self.extractor is None:
+            self.extractor = melspectrograms.BACKENDS[self.backend]()
+        audio = melspectrograms.load_audio(path,
+                                           segment_duration=melspectrograms.get_segment_duration(self.full_audio))
+        return self.extractor(audio)
+
+    def predict(self, mels):
+        """Probabilities of all tags for each mel-spectrogram, predicted on windows in batches of batch_size"""
+        windows = []
+        tracks = []
+        for track, mel in enumerate(mels):
+            for window in get_windows(mel, self.input_length, self.hop_length):
+                windows.append(window)
+                tracks.append(track)
+
+        out = []
+        with torch.no_grad():
+            for start in range(0, len(windows), self.batch_size):
+                x = torch.from_numpy(np.stack(windows[start:start + self.batch_size]).astype(np.float32))
+                if self.is_cuda:
+                    x = x.cuda()
+                out.append(self.model(x).cpu().numpy())
+        out = np.concatenate(out) if out else np.zeros((0, len(self.tag_list)), dtype=np.float32)
+
+        tracks = np.array(tracks, dtype=np.int64)
+        if self.aggregate == 'mean':
+            return [out[tracks == track].mean(axis=0) for track in range(len(mels))]
+        return [out[tracks == track].max(axis=0) for track in range(len(mels))]
+
+    def tag(self, requests):
+        """Responses to a batch of requests, with an error for the requests that could not be read"""
+        responses = [{'id': get_id(request)} for request in requests]
+        mels = []
+        tagged = []
+        for request, response in zip(requests, responses):
+            try:
+                mels.append(self.get_mel(request))
+                tagged.append(response)
+            except Exception as e:
+                response['error'] = '{}: {}'.format(type(e).__name__, e)
+
+        try:
+            predictions = self.predict(mels)
+        except Exception:
+            # Tracks are predicted one by one, so that only the request that fails gets the error
+            predictions = []
+            for response, mel in zip(tagged, mels):
+                try:
+                    predictions.append(self.predict([mel])[0])
+                except Exception as e:
+                    response['error'] = '{}: {}'.format(type(e).__name__, e)
+                    predictions.append(None)
+
+        for response, probabilities in zip(tagged, predictions):
+            if probabilities is not None:
+                response['tags'] = {tag: float(p) for tag, p in zip(self.tag_list, probabilities)}
+        return responses
+
+
+class MicroBatcher:
+    """Groups requests submitted from several threads into batches for the tagger: a batch is run as soon as it has
+    max_batch requests, or max_wait seconds after its first request"""
+
+    def __init__(self, tagger, max_batch=16, max_wait=0.05):
+        self.tagger = tagger
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, request):
+        """Queue that will receive the response to the request"""
+        response = queue.Queue(1)
+        if isinstance(request, dict):
+            self.requests.put((request, response))
+        else:
+            # Answered right away, only JSON objects reach the batches
+            response.put({'id': None, 'error': 'TypeError: request must be a JSON object, not {}'.format(
+                type(request).__name__)})
+        return response
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.requests.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+
+            # Every response is put, also if tagging fails, so that no client waits forever
+            try:
+                responses = self.tagger.tag([request for request, _ in batch])
+            except Exception as e:
+                error = '{}: {}'.format(type(e).__name__, e)
+                responses = [{'id': get_id(request), 'error': error} for request, _ in batch]
+            for (_, response), result in zip(batch, responses):
+                response.put(result)
+
+
+def serve_stdin(batcher):
+    # Responses are written by another thread, so that the following lines are read (and batched) in the meantime
+    pending = queue.Queue()
+
+    def write():
+        while True:
+            response = pending.get()
+            if response is None:
+                return
+            print(json.dumps(response.get()), flush=True)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            pending.put(batcher.submit(json.loads(line)))
+        except ValueError as e:
+            response = queue.Queue(1)
+            response.put({'error': 'ValueError: {}'.format(e)})
+            pending.put(response)
+    pending.put(None)
+    writer.join()
+
+
+def serve_http(batcher, host, port):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            try:
+                requests = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+
+            if isinstance(requests, list):
+                result = [response.get() for response in [batcher.submit(request) for request in requests]]
+            else:
+                result = batcher.submit(requests).get()
+
+            body = json.dumps(result).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print('Serving on http://{}:{}'.format(host, port), file=sys.stderr)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tags audio with a trained model loaded once, reading requests from '
+                                                 'stdin or HTTP and running them in batches',
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog=REQUEST_DESCRIPTION)
+    parser.add_argument('--model_save_path', type=str, default='./models',
+                        help='directory with best_model.pth (default: ./models)')
+    parser.add_argument('--model', type=str, default=None,
+                        help='model file, best_model.pth or a TorchScript .pt file written by export.py '
+                             '(default: best_model.pth in model_save_path)')
+    parser.add_argument('--threads', type=int, default=None, help='number of CPU threads (default: PyTorch default)')
+    parser.add_argument('--subset', type=str, default='all', choices=SUBSETS.keys(),
+                        help='subset the model was trained on (default: all)')
+    parser.add_argument('--batch_size', type=int, default=32, help='windows per model batch (default: 32)')
+    parser.add_argument('--input_length', type=int, default=1366, help='frames of each window (default: 1366)')
+    parser.add_argument('--hop_length', type=int, default=683, help='frames between windows (default: 683)')
+    parser.add_argument('--aggregate', type=str, default='mean', choices=['mean', 'max'],
+                        help='aggregation of the windows of a track (default: mean)')
+    parser.add_argument('--full', dest='full_audio', action='store_true',
+                        help='analyze full audio instead of a centered 29.1s segment')
+    parser.add_argument('--backend', type=str, default='essentia', choices=['essentia', 'numpy'],
+                        help='mel-spectrogram backend for audio (default: essentia)')
+    parser.add_argument('--max_batch', type=int, default=16, help='maximum requests per batch (default: 16)')
+    parser.add_argument('--max_wait', type=float, default=0.05,
+                        help='seconds to wait for more requests to batch (default: 0.05)')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='HTTP host (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=None, help='serve HTTP on this port instead of stdin/stdout')
+    config = parser.parse_args()
+
+    if config.threads is not None:
+        torch.set_num_threads(config.threads)
+    model_fn = config.model or os.path.join(config.model_save_path, 'best_model.pth')
+    tagger = Tagger(model_fn, config.subset, config.batch_size, config.input_length, config.hop_length,
+                    config.aggregate, config.full_audio, config.backend)
+    batcher = MicroBatcher(tagger, config.max_batch, config.max_wait)
+    if config.port is None:
+        serve_stdin(batcher)
+    else:
+        serve_http(batcher, config.host, config.port)
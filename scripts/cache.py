@@ -0,0 +1,163 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import util
+
+CACHE_DIR = os.environ.get('MTG_JAMENDO_CACHE',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'mtg-jamendo-dataset'))
+CACHE_MAX_SIZE = int(os.environ.get('MTG_JAMENDO_CACHE_MAX_SIZE', 2 * 1024 ** 3))  # 2GB
+HASH_BLOCK_SIZE = 4 * 1024 * 1024  # 4MB
+
+INDEX_FILE = 'index.json'
+INFO_FILE = 'info.json'
+
+
+def compute_sha256(filename, block_size=HASH_BLOCK_SIZE):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def get_size(directory):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(directory) for name in files)
+
+
+class ArrayCache:
+    """Cache of NumPy arrays computed from a source file, e.g. the parsed metadata of a TSV file.
+
+    Entries are stored as directories of NPY files (loaded memory-mapped) named after the SHA-256 of the source
+    file contents. The hash of each source file is remembered together with its size and mtime, so unchanged files
+    are not re-hashed. Least recently used entries are removed when the cache grows over `max_size` bytes.
+    """
+
+    def __init__(self, name, version, directory=CACHE_DIR, max_size=CACHE_MAX_SIZE):
+        self.directory = os.path.join(directory, name)
+        self.version = version
+        self.max_size = max_size
+
+    def _read_index(self):
+        try:
+            return util.read_json(os.path.join(self.directory, INDEX_FILE))
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        # The cache is only an optimization, failing to write it (e.g. read-only home) is not an error
+        try:
+            util.mkdir_p(self.directory)
+            with tempfile.NamedTemporaryFile('w', dir=self.directory, delete=False) as fp:
+                json.dump(index, fp)
+            os.replace(fp.name, os.path.join(self.directory, INDEX_FILE))
+        except OSError:
+            pass
+
+    def get_key(self, source_file):
+        """SHA-256 of the source file, only recomputed if its size or mtime changed"""
+        source_file = os.path.realpath(source_file)
+        stat = os.stat(source_file)
+        index = self._read_index()
+        entry = index.get(source_file)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return entry['sha256']
+
+        sha256 = compute_sha256(source_file)
+        index[source_file] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': sha256}
+        self._write_index(index)
+        return sha256
+
+    def load(self, source_file):
+        """Returns (arrays, info) stored for the source file or None if it is not cached"""
+        entry_dir = os.path.join(self.directory, self.get_key(source_file))
+        try:
+            info = util.read_json(os.path.join(entry_dir, INFO_FILE))
+        except (OSError, ValueError):
+            return None
+        if info.get('version') != self.version:
+            return None
+
+        try:
+            arrays = {name: np.load(os.path.join(entry_dir, name + '.npy'), mmap_mode='r')
+                      for name in info['arrays']}
+        except (OSError, ValueError):
+            return None
+
+        try:
+            os.utime(os.path.join(entry_dir, INFO_FILE))  # mark as recently used
+        except OSError:
+            pass
+        return arrays, info['info']
+
+    def save(self, source_file, arrays, info):
+        entry_dir = os.path.join(self.directory, self.get_key(source_file))
+
+        # Write to a temporary directory first so that readers never see a partial entry
+        try:
+            util.mkdir_p(self.directory)
+            tmp_dir = tempfile.mkdtemp(dir=self.directory)
+        except OSError:
+            return
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_dir, name + '.npy'), array, allow_pickle=False)
+            with open(os.path.join(tmp_dir, INFO_FILE), 'w') as fp:
+                json.dump({'version': self.version, 'arrays': list(arrays), 'info': info}, fp)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in `max_size`"""
+        entries = []
+        for name in os.listdir(self.directory):
+            entry_dir = os.path.join(self.directory, name)
+            info_file = os.path.join(entry_dir, INFO_FILE)
+            if os.path.isfile(info_file):
+                entries.append((os.path.getmtime(info_file), get_size(entry_dir), entry_dir))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+    def invalidate(self, source_file=None):
+        """Removes the entry for the source file, or the whole cache if no file is given"""
+        if source_file is None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            return
+
+        source_file = os.path.realpath(source_file)
+        index = self._read_index()
+        entry = index.pop(source_file, None)
+        if entry is not None:
+            shutil.rmtree(os.path.join(self.directory, entry['sha256']), ignore_errors=True)
+            self._write_index(index)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manages the cache of parsed files (location is set by the '
+                                                 'MTG_JAMENDO_CACHE environment variable, default {})'.format(CACHE_DIR))
+    parser.add_argument('name', help='cache name (e.g. metadata)')
+    parser.add_argument('--clear', nargs='*', metavar='FILE',
+                        help='remove cached entries for the given source files, or all of them if no file is given')
+    args = parser.parse_args()
+
+    array_cache = ArrayCache(args.name, version=None)
+    if args.clear is not None:
+        for source_file in args.clear or [None]:
+            array_cache.invalidate(source_file)
+
+    if os.path.isdir(array_cache.directory):
+        print('{}: {:.1f} MB'.format(array_cache.directory, get_size(array_cache.directory) / 1024 ** 2))
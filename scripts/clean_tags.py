@@ -4,13 +4,13 @@ import commons
 import util
 
 
-def merge_tags(tracks, tag_map_all):
-    for track_id, track in tracks.items():
-        for category, tag_map in tag_map_all.items():
-            tags_original = track[category] & tag_map.keys()
-            if len(tags_original) > 0:
-                tags_new = {tag_map[tag] for tag in tags_original}
-                track[category] = track[category] - tags_original | tags_new
+def merge_tags(metadata, tag_map_all):
+    tags_new = []
+    for tag_str in metadata.tags:
+        category, tag = tag_str.split(commons.TAG_HYPHEN)
+        tag = tag_map_all.get(category, {}).get(tag, tag)
+        tags_new.append(category + commons.TAG_HYPHEN + tag)
+    return metadata.rename_tags(tags_new)
 
 
 if __name__ == '__main__':
@@ -20,7 +20,7 @@ if __name__ == '__main__':
     parser.add_argument('output_file', help='output tsv file')
     args = parser.parse_args()
 
-    tracks, tags, extra = commons.read_file(args.tsv_file)
+    metadata = commons.read_metadata(args.tsv_file)
     tag_map = util.read_json(args.map_file)
-    merge_tags(tracks, tag_map)
-    commons.write_file(tracks, args.output_file, extra)
+    metadata = merge_tags(metadata, tag_map)
+    commons.write_metadata(metadata, args.output_file)
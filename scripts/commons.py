@@ -1,10 +1,16 @@
 import csv
 from collections import defaultdict
 
+import numpy as np
+
+import cache
+
 
 CATEGORIES = ['genre', 'instrument', 'mood/theme']
 TAG_HYPHEN = '---'
 METADATA_DESCRIPTION = 'TSV file with such columns: TRACK_ID, ARTIST_ID, ALBUM_ID, PATH, DURATION, TAGS'
+METADATA_BLOCK_SIZE = 64 * 1024 * 1024  # 64MB
+METADATA_CACHE = cache.ArrayCache('metadata', version=1)
 
 
 def get_id(value):
@@ -86,3 +92,293 @@ def write_file(tracks, tsv_file, extra):
         writer.writerow(['TRACK_ID', 'ARTIST_ID', 'ALBUM_ID', 'PATH', 'DURATION', 'TAGS'])
         for row in rows:
             writer.writerow(row)
+
+
+def get_categories(tag_categories):
+    """Unique categories, in the order of CATEGORIES followed by unknown ones"""
+    present = set(tag_categories)
+    return [category for category in CATEGORIES if category in present] + sorted(present - set(CATEGORIES))
+
+
+class Metadata:
+    """Columnar representation of a metadata file.
+
+    Track attributes are stored as arrays (one entry per track, in file order), tags are integer-coded against
+    `tags`, an alphabetically sorted vocabulary of 'category---tag' strings, and the track x tag assignment is a
+    sparse matrix in CSR format: the tags of track `i` are `indices[indptr[i]:indptr[i + 1]]` (sorted, unique).
+    """
+
+    def __init__(self, track_ids, artist_ids, album_ids, paths, durations, tags, indptr, indices, extra=None):
+        self.track_ids = np.asarray(track_ids, dtype=np.int64)
+        self.artist_ids = np.asarray(artist_ids, dtype=np.int64)
+        self.album_ids = np.asarray(album_ids, dtype=np.int64)
+        self.paths = np.asarray(paths, dtype=object)
+        self.durations = np.asarray(durations, dtype=np.float64)
+        self.tags = list(tags)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+
+        tag_categories, self.tag_names = zip(*[tag.split(TAG_HYPHEN) for tag in self.tags]) if self.tags else ((), ())
+        self.categories = get_categories(tag_categories)
+        self.tag_categories = np.array([self.categories.index(category) for category in tag_categories],
+                                       dtype=np.int8)
+
+        if extra is None:
+            extra = {
+                'track_id_length': get_length(self.track_ids),
+                'artist_id_length': get_length(self.artist_ids),
+                'album_id_length': get_length(self.album_ids)
+            }
+        self.extra = extra
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    @property
+    def tag_rows(self):
+        """Track index for each entry of `indices`"""
+        return np.repeat(np.arange(len(self)), np.diff(self.indptr))
+
+    def category_mask(self, category):
+        if category not in self.categories:
+            return np.zeros(len(self.tags), dtype=bool)
+        return self.tag_categories == self.categories.index(category)
+
+    def subset_mask(self, tags_subset):
+        """Tag mask for a {category: set(tags)} subset; categories missing from the subset are kept as is"""
+        mask = np.ones(len(self.tags), dtype=bool)
+        for i, (category, tag) in enumerate(zip(self.tag_categories, self.tag_names)):
+            category = self.categories[category]
+            if category in tags_subset:
+                mask[i] = tag in tags_subset[category]
+        return mask
+
+    def tag_tracks(self, tag):
+        """Track ids annotated with a 'category---tag' string"""
+        column = self.tags.index(tag)
+        return self.track_ids[self.tag_rows[self.indices == column]]
+
+    def track_tags(self, i):
+        return [self.tags[column] for column in self.indices[self.indptr[i]:self.indptr[i + 1]]]
+
+    def track_counts(self):
+        """Number of tracks per tag"""
+        return np.bincount(self.indices, minlength=len(self.tags))
+
+    def unique_counts(self, ids):
+        """Number of unique values of `ids` (one per track, e.g. `artist_ids`) per tag"""
+        _, codes = np.unique(ids, return_inverse=True)
+        n_codes = codes.max() + 1 if len(codes) else 1
+        pairs = np.unique(self.indices.astype(np.int64) * n_codes + codes[self.tag_rows])
+        return np.bincount(pairs // n_codes, minlength=len(self.tags))
+
+    def select_tracks(self, selection):
+        """New metadata with tracks selected by a boolean mask or an index array (in the given order)"""
+        selection = np.asarray(selection)
+        if selection.dtype == bool:
+            selection = np.flatnonzero(selection)
+
+        lengths = np.diff(self.indptr)[selection]
+        indptr = np.zeros(len(selection) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        offsets = np.repeat(self.indptr[selection] - indptr[:-1], lengths)
+        indices = self.indices[offsets + np.arange(indptr[-1])]
+
+        return Metadata(self.track_ids[selection], self.artist_ids[selection], self.album_ids[selection],
+                        self.paths[selection], self.durations[selection], self.tags, indptr, indices, self.extra)
+
+    def select_tags(self, mask):
+        """New metadata with only the tags in a boolean mask over `tags`, tracks with no tags left are removed"""
+        mask = np.asarray(mask, dtype=bool)
+        keep = mask[self.indices]
+        remap = np.cumsum(mask) - 1
+
+        counts = np.bincount(self.tag_rows[keep], minlength=len(self))
+        indptr = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        tags = [tag for tag, selected in zip(self.tags, mask) if selected]
+
+        metadata = Metadata(self.track_ids, self.artist_ids, self.album_ids, self.paths, self.durations, tags,
+                            indptr, remap[self.indices[keep]], self.extra)
+        return metadata.select_tracks(counts > 0)
+
+    def rename_tags(self, new_tags):
+        """New metadata with each tag in `tags` replaced by the corresponding 'category---tag' in `new_tags`, tags
+        that are renamed to the same tag are merged"""
+        tags = sorted(set(new_tags))
+        remap = np.searchsorted(tags, new_tags)
+        rows = self.tag_rows
+        keys = np.unique(rows * max(len(tags), 1) + remap[self.indices])
+        indptr = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys // max(len(tags), 1), minlength=len(self)), out=indptr[1:])
+        return Metadata(self.track_ids, self.artist_ids, self.album_ids, self.paths, self.durations, tags,
+                        indptr, keys % max(len(tags), 1), self.extra)
+
+    def to_arrays(self):
+        """Arrays and JSON-serializable info to store the metadata (see `from_arrays`)"""
+        arrays = {
+            'track_ids': self.track_ids,
+            'artist_ids': self.artist_ids,
+            'album_ids': self.album_ids,
+            'durations': self.durations,
+            'indptr': self.indptr,
+            'indices': self.indices,
+            'paths': np.frombuffer('\n'.join(self.paths).encode(), dtype=np.uint8)
+        }
+        return arrays, {'tags': self.tags, 'extra': self.extra}
+
+    @classmethod
+    def from_arrays(cls, arrays, info):
+        paths = arrays['paths'].tobytes().decode().split('\n') if len(arrays['track_ids']) else []
+        return cls(arrays['track_ids'], arrays['artist_ids'], arrays['album_ids'], paths, arrays['durations'],
+                   info['tags'], arrays['indptr'], arrays['indices'], info['extra'])
+
+    @classmethod
+    def from_tracks(cls, tracks, extra=None):
+        """Converts the `tracks` dictionary returned by `read_file`"""
+        tags = sorted({category + TAG_HYPHEN + tag
+                       for track in tracks.values() for category in CATEGORIES for tag in track[category]})
+        tag_index = {tag: i for i, tag in enumerate(tags)}
+
+        indptr = [0]
+        indices = []
+        for track in tracks.values():
+            indices += sorted(tag_index[category + TAG_HYPHEN + tag] for category in CATEGORIES
+                              for tag in track[category])
+            indptr.append(len(indices))
+
+        return cls([track_id for track_id in tracks],
+                   [track['artist_id'] for track in tracks.values()],
+                   [track['album_id'] for track in tracks.values()],
+                   [track['path'] for track in tracks.values()],
+                   [track['duration'] for track in tracks.values()],
+                   tags, indptr, indices, extra)
+
+    def to_tracks(self):
+        """Converts to the `tracks` dictionary format of `read_file`"""
+        tracks = {}
+        for i, track_id in enumerate(self.track_ids.tolist()):
+            track_tags = self.track_tags(i)
+            tracks[track_id] = {
+                'artist_id': int(self.artist_ids[i]),
+                'album_id': int(self.album_ids[i]),
+                'path': self.paths[i],
+                'duration': float(self.durations[i]),
+                'tags': track_tags,
+            }
+            tracks[track_id].update({category: set() for category in CATEGORIES})
+            for tag_str in track_tags:
+                category, tag = tag_str.split(TAG_HYPHEN)
+                tracks[track_id][category].add(tag)
+        return tracks
+
+
+def _parse_ids(values):
+    # Ids are formatted as prefix_number (see get_id)
+    return np.array([value.partition('_')[2] for value in values]).astype(np.int64)
+
+
+def _parse_lines(lines):
+    # Fields of this format never contain tabs or quotes, so there is no need for csv quoting rules
+    rows = [line.rstrip('\n').split('\t', 5) for line in lines]
+    track_ids, artist_ids, album_ids, paths, durations = [[row[i] for row in rows] for i in range(5)]
+    tag_fields = [row[5] if len(row) > 5 else '' for row in rows]
+
+    # Decode tags of the whole batch at once: split all of them in one go, integer-code them and recode the codes
+    # to the alphabetical order of the vocabulary
+    counts = np.array([field.count('\t') + 1 if field else 0 for field in tag_fields], dtype=np.int64)
+    tokens = '\t'.join(field for field in tag_fields if field).split('\t') if counts.sum() else []
+    tag_index = {}
+    codes = np.array([tag_index.setdefault(token, len(tag_index)) for token in tokens], dtype=np.int64)
+    tags = sorted(tag_index)
+    order = np.empty(len(tags), dtype=np.int64)
+    order[[tag_index[tag] for tag in tags]] = np.arange(len(tags))
+
+    # Drop duplicate tags within a track and sort them, that is the CSR layout Metadata expects
+    n_tags = max(len(tags), 1)
+    keys = np.sort(np.repeat(np.arange(len(rows)), counts) * n_tags + order[codes])
+    keys = keys[np.concatenate([[True], keys[1:] != keys[:-1]])]
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys // n_tags, minlength=len(rows)), out=indptr[1:])
+
+    return Metadata(_parse_ids(track_ids), _parse_ids(artist_ids), _parse_ids(album_ids), paths,
+                    np.array(durations, dtype=np.float64), tags, indptr, keys % n_tags)
+
+
+def iter_metadata(tsv_file, block_size=METADATA_BLOCK_SIZE):
+    """Streams a metadata file in blocks of roughly `block_size` bytes, yielding a Metadata object for each block.
+
+    Each batch has its own tag vocabulary and its `extra` only reflects the ids in the batch, use `read_metadata`
+    to get the whole file at once."""
+    with open(tsv_file) as fp:
+        next(fp, None)  # skip header
+        while True:
+            lines = fp.readlines(block_size)
+            if not lines:
+                break
+            yield _parse_lines(lines)
+
+
+def concatenate_metadata(batches, extra=None):
+    """Merges Metadata objects into one, unifying their tag vocabularies"""
+    batches = list(batches)
+    tags = sorted(set().union(*[batch.tags for batch in batches]))
+
+    indptr = [np.zeros(1, dtype=np.int64)]
+    indices = []
+    offset = 0
+    for batch in batches:
+        # Both vocabularies are sorted, so the recoded tags stay sorted within each track
+        indices.append(np.searchsorted(tags, batch.tags).astype(np.int32)[batch.indices])
+        indptr.append(batch.indptr[1:] + offset)
+        offset += batch.indptr[-1]
+
+    def concatenate(attribute):
+        return np.concatenate([getattr(batch, attribute) for batch in batches])
+
+    return Metadata(concatenate('track_ids'), concatenate('artist_ids'), concatenate('album_ids'),
+                    concatenate('paths'), concatenate('durations'), tags,
+                    np.concatenate(indptr), np.concatenate(indices), extra)
+
+
+def read_metadata(tsv_file, use_cache=True):
+    """Reads a metadata file, parsed files are cached (see cache.ArrayCache) and loaded memory-mapped next time"""
+    cached = METADATA_CACHE.load(tsv_file) if use_cache else None
+    if cached is not None:
+        metadata = Metadata.from_arrays(*cached)
+    else:
+        metadata = concatenate_metadata(iter_metadata(tsv_file))
+        if use_cache:
+            METADATA_CACHE.save(tsv_file, *metadata.to_arrays())
+
+    print("Reading: {} tracks, {} albums, {} artists".format(
+        len(metadata), len(np.unique(metadata.album_ids)), len(np.unique(metadata.artist_ids))))
+    return metadata
+
+
+def clear_metadata_cache(tsv_file=None):
+    METADATA_CACHE.invalidate(tsv_file)
+
+
+def write_metadata(metadata, tsv_file):
+    extra = metadata.extra
+    # Vocabulary is sorted, so are tags within each track
+    tags = [tag if tag.split(TAG_HYPHEN)[0] in CATEGORIES else None for tag in metadata.tags]
+
+    with open(tsv_file, 'w') as fp:
+        writer = csv.writer(fp, delimiter='\t')
+        writer.writerow(['TRACK_ID', 'ARTIST_ID', 'ALBUM_ID', 'PATH', 'DURATION', 'TAGS'])
+        indptr = metadata.indptr.tolist()
+        indices = metadata.indices.tolist()
+        for i, (track_id, artist_id, album_id, path, duration) in enumerate(zip(
+                metadata.track_ids.tolist(), metadata.artist_ids.tolist(), metadata.album_ids.tolist(),
+                metadata.paths, metadata.durations.tolist())):
+            row = [
+                'track_' + str(track_id).zfill(extra['track_id_length']),
+                'artist_' + str(artist_id).zfill(extra['artist_id_length']),
+                'album_' + str(album_id).zfill(extra['album_id_length']),
+                path,
+                duration
+            ]
+            row += [tags[column] for column in indices[indptr[i]:indptr[i + 1]] if tags[column] is not None]
+            writer.writerow(row)
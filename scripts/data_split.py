@@ -1,13 +1,17 @@
 import argparse
 import csv
 import collections
+import io
 import random
 import sys
 import math
 import logging
 import os
-import copy
 import itertools
+import multiprocessing
+import time
+
+import numpy as np
 
 import util
 
@@ -31,8 +35,8 @@ VALIDATION = "validation"
 config = {}
 
 
-def _split_artists(artistids):
-    random.shuffle(artistids)
+def _split_artists(artistids, rng):
+    rng.shuffle(artistids)
     art_len = len(artistids)
     train_count = int(math.ceil(art_len * config['split_ratio'][TRAIN] / 100.))
     test_count = int(math.ceil(art_len * config['split_ratio'][TEST] / 100.))
@@ -86,6 +90,67 @@ def _tags_by_category(tags):
     return tags_genres, tags_moods, tags_instruments
 
 
+PARTS = [TRAIN, TEST, VALIDATION]
+# Header of the file with the partition of every artist of a split
+ARTISTS_HEADER = ["ARTIST_ID", "PART"]
+
+# Maximum number of combinations of solutions tried when selecting the final splits
+MAX_COMBINATIONS = 10000
+# Initial and final temperature of simulated annealing
+ANNEAL_TEMPERATURE = (1.0, 0.01)
+
+# Data shared by all trials, set once per process by _init_trials
+trial_data = {}
+
+
+def _build_tag_counts(groundtruth, track_to_artist, artists, tags):
+    """Artist x tag matrix with the number of tracks of each artist annotated with each tag"""
+    artist_index = {artist: i for i, artist in enumerate(artists)}
+    tag_index = {tag: i for i, tag in enumerate(tags)}
+    artist_codes = []
+    tag_codes = []
+    for trackid, track_tags in groundtruth.items():
+        artist_codes += [artist_index[track_to_artist[trackid]]] * len(track_tags)
+        tag_codes += [tag_index[t] for t in track_tags]
+
+    counts = np.zeros((len(artists), len(tags)), dtype=np.int64)
+    np.add.at(counts, (artist_codes, tag_codes), 1)
+    return counts
+
+
+def _init_trials(trial_config, artists, tags, tag_counts):
+    config.update(trial_config)
+    # Counts are kept as floats so that products go through BLAS, they are exact for any realistic count
+    trial_data.update(artists=artists, tags=tags, tags_by_category=_tags_by_category(tags),
+                      tag_counts=tag_counts.astype(np.float64), tag_presence=(tag_counts > 0).astype(np.float64),
+                      thresholds=[np.array([max(config[threshold][part], 1) for part in PARTS],
+                                           dtype=np.float64)[:, np.newaxis]
+                                  for threshold in ['artist_threshold', 'track_threshold']])
+
+
+def _run_trial(trialnumber):
+    # Every trial has its own random generator, so results do not depend on the order in which trials are run
+    rng = random.Random("%s-%s" % (config['seed'], trialnumber))
+
+    # Randomly split artists into sections
+    log.debug("Trial %s", trialnumber)
+    artist_splits = _split_artists(list(trial_data['artists']), rng)
+    if config['search'] == 'anneal':
+        artist_splits = anneal_split(artist_splits, rng)
+    discarded_tags = evaluate_split(artist_splits, trialnumber)
+    return len(discarded_tags), trialnumber, discarded_tags, artist_splits
+
+
+def _keep_best_solutions(solutions):
+    # Only keep the best solutions (this saves memory load). Ties are ordered by trial number, so the result is the
+    # same whatever order trials finish in
+    solutions = sorted(solutions, key=lambda s: s[:2])
+    if len(solutions) > config['splits']:
+        best_discarded = solutions[config['splits']][0]
+        solutions = [s for s in solutions if s[0] <= best_discarded]
+    return solutions
+
+
 def run_trials(groundtruthfile):
     groundtruth, groundtruth_meta, track_to_artist, artist_to_tracks, header = _load_groundtruth(groundtruthfile)
 
@@ -94,202 +159,231 @@ def run_trials(groundtruthfile):
         for t in tags:
             tag_to_tracks[t].append(trackid)
 
-    artists = artist_to_tracks.keys()
+    # Tag counts per artist are computed once, each trial only sums them up for its split of artists
+    artists = list(artist_to_tracks.keys())
+    tags = list(tag_to_tracks.keys())
+    tag_counts = _build_tag_counts(groundtruth, track_to_artist, artists, tags)
 
     solutions = []
     total_tags = len(tag_to_tracks)
 
-    for trialnumber in range(config['trials']):
-        # Randomly split artists into sections
-        log.debug("Trial %s", trialnumber)
-        log.debug("Splitting by artists")
-        artist_splits = _split_artists(list(artists))
-        train, test, validation, discarded_tags = split_groundtruth(dict(groundtruth), track_to_artist, artist_to_tracks, tag_to_tracks, artist_splits, trialnumber)
-        solutions.append((len(discarded_tags), discarded_tags, train, test, validation))
-
-        # Only keep the best solutions (this saves memory load)
-        solutions = sorted(solutions)
-        if len(solutions) > config['splits']:
-            best_discarded = solutions[config['splits']][0]
-            solutions = [s for s in solutions if s[0] <= best_discarded]
+    log.debug("Running %s trials with seed %s (%s jobs)", config['trials'], config['seed'], config['jobs'])
+    trial_args = (dict(config), artists, tags, tag_counts)
+    if config['jobs'] > 1:
+        with multiprocessing.Pool(config['jobs'], initializer=_init_trials, initargs=trial_args) as pool:
+            for solution in pool.imap_unordered(_run_trial, range(config['trials']), chunksize=16):
+                solutions = _keep_best_solutions(solutions + [solution])
+    else:
+        _init_trials(*trial_args)
+        for trialnumber in range(config['trials']):
+            solutions = _keep_best_solutions(solutions + [_run_trial(trialnumber)])
 
     log.debug("")
     log.debug("-" * 10 + " Best trials " + "-" * 10)
     for s in solutions:
-        log.debug("- Discarded %s out of %s tags: %s", s[0], total_tags, sorted(list(s[1])))
+        log.debug("- Trial %s: discarded %s out of %s tags: %s", s[1], s[0], total_tags, sorted(list(s[2])))
 
     # We want all subsets to have the same tags. Select the best set of splits
     # that minimized the amout of discarded tracks.
-    selections = list(itertools.combinations(solutions, config['splits']))
-    selections = [(set([t for s in selection for t in s[1]]), selection) for selection in selections]
-    selections = [(len(tags), sorted(list(tags)), selection) for tags, selection in selections]
-    _, discarded_tags, best_selection = sorted(selections)[0]
+    discarded_tags, best_selection = select_solutions(solutions)
 
     log.debug("")
     log.debug("-" * 10 + " Best solution: " + "-" * 10)
     log.debug("Discarded %s tags: %s", len(discarded_tags), discarded_tags)
 
     for i in range(len(best_selection)):
-        _, _, train, test, validation = best_selection[i]
+        _, trialnumber, _, artist_splits = best_selection[i]
+        log.debug("Split %s: trial %s", i, trialnumber)
+        train, test, validation = split_groundtruth(groundtruth, track_to_artist, artist_splits)
         train = remove_tags_from_groundtruth(train, discarded_tags, tag_to_tracks)
         test = remove_tags_from_groundtruth(test, discarded_tags, tag_to_tracks)
         validation = remove_tags_from_groundtruth(validation, discarded_tags, tag_to_tracks)
-
-        gt_dir = os.path.dirname(groundtruthfile)
-        gt_file = os.path.basename(groundtruthfile)
-        gt_name, gt_ext = os.path.splitext(gt_file)
-
-        splitdir = "split-%s" % i
-        util.mkdir_p(splitdir)
-
-        for part, data in [("train", train), ("test", test), ("validation", validation)]:
-            out_file = os.path.join(splitdir, "%s-%s%s" % (gt_name, part, gt_ext))
-            log.debug("Writing part %s to file %s", part, out_file)
-            with open(out_file, "w") as fp:
-                w = csv.writer(fp, delimiter="\t")
-                w.writerow(header)
-                for trackid, tags in data.items():
-                    row = [trackid] + groundtruth_meta[trackid] + list(tags)
-                    w.writerow(row)
-
-
-def discard_tags_by_count(tag_split_artists, tag_split_tracks):
-    # Tags below the minimum artist count for train/test/validation
-    discard_tags_artist = tag_split_artists
-    for t in list(discard_tags_artist.keys()):
-        if (len(discard_tags_artist[t][TRAIN]) >= config['artist_threshold'][TRAIN] and 
-            len(discard_tags_artist[t][TEST]) >= config['artist_threshold'][TEST] and 
-            len(discard_tags_artist[t][VALIDATION]) >= config['artist_threshold'][VALIDATION]):
-            del discard_tags_artist[t]
-
-    # Tags below the minimum track count for train/test/validation
-    discard_tags_track = tag_split_tracks
-    for t in list(discard_tags_track.keys()):
-        if (len(discard_tags_track[t][TRAIN]) >= config['track_threshold'][TRAIN] and 
-            len(discard_tags_track[t][TEST]) >= config['track_threshold'][TEST] and 
-            len(discard_tags_track[t][VALIDATION]) >= config['track_threshold'][VALIDATION]):
-            del discard_tags_track[t]
-
-    log.debug("Tags with insufficient artist counts: %s", discard_tags_artist.keys())
-    log.debug("Tags with insufficient track counts: %s", discard_tags_track.keys())
-
-    tags_to_remove = set(list(discard_tags_artist.keys()) + list(discard_tags_track.keys()))
-    return tags_to_remove
-
-
-def split_groundtruth(groundtruth, track_to_artist, artist_to_tracks, tag_to_tracks, artist_splits, trialnumber):
-
-    log.debug("Making mapping of tag counts")
-        
-    track_splits = {}
-    for artist, group in artist_splits.items():
-        for t in artist_to_tracks[artist]:
-            track_splits[t] = group
-
-    # Mapping from tags to tracks and artists
-    tag_split_artists = collections.defaultdict(lambda: { TRAIN: set(), TEST: set(), VALIDATION: set() })
-    tag_split_tracks = collections.defaultdict(lambda: { TRAIN: [], TEST: [], VALIDATION: [] })
-
-    for trackid, tags in groundtruth.items():
-        artistid = track_to_artist[trackid]
-        group = artist_splits[artistid]
-        for t in tags:
-            tag_split_artists[t][group].add(artistid)
-            tag_split_tracks[t][group].append(trackid)
-
-    original_number_tags = len(tag_to_tracks)
-    original_genres, original_moods, original_instruments = _tags_by_category(tag_to_tracks.keys())
-
-    log.debug("-" * 80)
-    for t in tag_to_tracks.keys():
-        log.debug("Tag: %s\tartist counts: %s - %s - %s\ttrack counts: %s - %s - %s", t, 
-                      len(tag_split_artists[t][TRAIN]), 
-                      len(tag_split_artists[t][TEST]),
-                      len(tag_split_artists[t][VALIDATION]),
-                      len(tag_split_tracks[t][TRAIN]), 
-                      len(tag_split_tracks[t][TEST]),
-                      len(tag_split_tracks[t][VALIDATION]))
-    log.debug("-" * 80)
-
-    tags_to_remove = discard_tags_by_count(tag_split_artists, tag_split_tracks)
-    discarded_tags = tags_to_remove
-
-    # Remove these labels from all items in the ground truth
-    # Remove all items in the groundtruth which now have no labels
-
-    log.debug("GT currently has %s tracks", len(groundtruth))
-    log.debug("Number of unique tags: %s", len(tag_to_tracks))
-    log.debug("Going to remove these tags: %s", sorted(list(tags_to_remove)))
-    num_removed_tags = len(tags_to_remove)
-    remove_genres, remove_moods, remove_instruments = _tags_by_category(tags_to_remove)
-
-    groundtruth = remove_tags_from_groundtruth(groundtruth, tags_to_remove, tag_to_tracks)
-
-    log.debug("After filtering, GT has %s tracks", len(groundtruth))
-
-
-    log.debug("Building train/test/validation splits of tracks")
-    # Take the intersection of all labels in train/test/validation. 
-    # These are the labels that we're going to use
-    # Filter any label which is not these from the ground truth
-
-    train = {}
-    test = {}
-    validation = {}
-    for trackid, tags in groundtruth.items():
-        if track_splits.get(trackid) == TRAIN:
-            train[trackid] = tags
-        elif track_splits.get(trackid) == TEST:
-            test[trackid] = tags
-        elif track_splits.get(trackid) == VALIDATION:
-            validation[trackid] = tags
-
-    log.debug("train: %s\ntest: %s\nvalidation: %s", len(train), len(test), len(validation))
-
-    all_tags_in_train = _get_all_tags_in_gt(train)
-    all_tags_in_test = _get_all_tags_in_gt(test)
-    all_tags_in_validation = _get_all_tags_in_gt(validation)
-    log.debug("%s tags in train", len(all_tags_in_train))
-    log.debug("%s tags in test", len(all_tags_in_test))
-    log.debug("%s tags in validation", len(all_tags_in_validation))
-
-    intersection_tags = all_tags_in_train & all_tags_in_test & all_tags_in_validation
-    union_tags = all_tags_in_train | all_tags_in_test | all_tags_in_validation
-    # Tags to remove is union-intersection
-
-    log.debug("%s tags in union of train-test-validation", len(union_tags))
-    log.debug("%s tags in intersection of train-test-validation", len(intersection_tags))
-    tags_to_remove = union_tags - intersection_tags
-    discarded_tags = discarded_tags | tags_to_remove
-    log.debug("need to remove %s tags which don't appear in all splits", len(tags_to_remove))
-    log.debug("going to remove these tags: %s", sorted(list(tags_to_remove)))
-
-    num_removed_tags += len(tags_to_remove)
-
-    train = remove_tags_from_groundtruth(train, tags_to_remove, tag_to_tracks)
-    test = remove_tags_from_groundtruth(test, tags_to_remove, tag_to_tracks)
-    validation = remove_tags_from_groundtruth(validation, tags_to_remove, tag_to_tracks)
-
-    log.debug("after filtering\ntrain: %s\ntest: %s\nvalidation: %s", len(train), len(test), len(validation))
-
-    final_number_tags = original_number_tags - num_removed_tags
-    log.debug("Keeping %s tags (%s%%):", final_number_tags, final_number_tags*100.0/original_number_tags)
+        log.debug("train: %s\ntest: %s\nvalidation: %s", len(train), len(test), len(validation))
+
+        gt_name, gt_ext = os.path.splitext(os.path.basename(groundtruthfile))
+        write_split("split-%s" % i, gt_name, gt_ext, header, groundtruth_meta, [train, test, validation],
+                    artist_splits)
+
+
+def write_split(splitdir, gt_name, gt_ext, header, groundtruth_meta, parts, artist_splits, only_changed=False):
+    """Writes train/test/validation ground-truth of a split, and the partition of every artist (also of artists
+    without tracks left once tags are discarded) for incremental updates. With `only_changed`, files that already
+    have the same contents are not rewritten"""
+    util.mkdir_p(splitdir)
+
+    outputs = []
+    for part, data in zip(PARTS, parts):
+        output = io.StringIO()
+        w = csv.writer(output, delimiter="\t")
+        w.writerow(header)
+        for trackid, tags in data.items():
+            row = [trackid] + groundtruth_meta[trackid] + sorted(tags)
+            w.writerow(row)
+        outputs.append((part, os.path.join(splitdir, "%s-%s%s" % (gt_name, part, gt_ext)), output))
+
+    output = io.StringIO()
+    w = csv.writer(output, delimiter="\t")
+    w.writerow(ARTISTS_HEADER)
+    for artist in sorted(artist_splits):
+        w.writerow([artist, artist_splits[artist]])
+    outputs.append(("artists", _artists_file(splitdir, gt_name, gt_ext), output))
+
+    for part, out_file, output in outputs:
+        if only_changed and os.path.isfile(out_file):
+            with open(out_file, newline='') as fp:
+                if fp.read() == output.getvalue():
+                    log.debug("Part %s is unchanged in file %s", part, out_file)
+                    continue
+
+        log.debug("Writing part %s to file %s", part, out_file)
+        with open(out_file, "w") as fp:
+            fp.write(output.getvalue())
+
+
+def _count_combinations(n, k):
+    """Number of combinations of k out of n items (math.comb is only available since Python 3.8)"""
+    if k < 0 or k > n:
+        return 0
+    count = 1
+    for i in range(min(k, n - k)):
+        count = count * (n - i) // (i + 1)
+    return count
+
+
+def select_solutions(solutions):
+    """Selects `splits` solutions minimizing the union of their discarded tags. All combinations are tried if there
+    are at most MAX_COMBINATIONS of them, otherwise solutions are added greedily"""
+    if _count_combinations(len(solutions), config['splits']) <= MAX_COMBINATIONS:
+        selections = itertools.combinations(solutions, config['splits'])
+        selections = [(set([t for s in selection for t in s[2]]), selection) for selection in selections]
+        selections = [(len(tags), sorted(list(tags)), selection) for tags, selection in selections]
+        _, discarded_tags, best_selection = min(selections, key=lambda selection: selection[:2])
+        return discarded_tags, best_selection
+
+    log.debug("Too many combinations of %s solutions, selecting splits greedily", len(solutions))
+    discarded_tags = set()
+    best_selection = []
+    remaining = list(solutions)
+    while len(best_selection) < config['splits']:
+        # Solutions are sorted by (number of discarded tags, trial number), min keeps the first of ties
+        best = min(remaining, key=lambda s: len(discarded_tags | s[2]))
+        remaining.remove(best)
+        best_selection.append(best)
+        discarded_tags |= best[2]
+    return sorted(list(discarded_tags)), tuple(best_selection)
+
+
+def _split_cost(split_artist_counts, split_track_counts):
+    """Number of discarded tags plus how far (relative to the thresholds) tags are from being kept, so that the
+    search can make progress on tags that are still discarded"""
+    artist_threshold, track_threshold = trial_data['thresholds']
+    shortfall = (np.maximum(artist_threshold - split_artist_counts, 0) / artist_threshold).sum(axis=0)
+    shortfall += (np.maximum(track_threshold - split_track_counts, 0) / track_threshold).sum(axis=0)
+    shortfall += (split_track_counts == 0).sum(axis=0)
+    return np.count_nonzero(shortfall) + shortfall.sum()
+
+
+def anneal_split(artist_splits, rng):
+    """Improves a split with simulated annealing, swapping pairs of artists between partitions (so that the
+    number of artists in each partition does not change) until no tag is discarded, `anneal_steps` swaps were
+    tried or the `time_budget` in seconds is over"""
+    artists = trial_data['artists']
+    tag_counts = trial_data['tag_counts']
+    tag_presence = trial_data['tag_presence']
+    splits = np.array([PARTS.index(artist_splits[artist]) for artist in artists])
+    assignment = np.array([splits == i for i in range(len(PARTS))], dtype=np.float64)
+    split_track_counts = assignment @ tag_counts
+    split_artist_counts = assignment @ tag_presence
+
+    cost = _split_cost(split_artist_counts, split_track_counts)
+    best_cost, best_splits = cost, splits.copy()
+    steps = config['anneal_steps']
+    deadline = time.time() + config['time_budget'] if config['time_budget'] else None
+    tried = 0
+    for step in range(steps):
+        if best_cost == 0 or (deadline is not None and step % 100 == 0 and time.time() > deadline):
+            break
+        tried += 1
+
+        a, b = rng.randrange(len(artists)), rng.randrange(len(artists))
+        p, q = splits[a], splits[b]
+        if p == q:
+            continue
+
+        # Move artist a from p to q and artist b from q to p
+        track_delta = tag_counts[b] - tag_counts[a]
+        artist_delta = tag_presence[b] - tag_presence[a]
+        split_track_counts[p] += track_delta
+        split_track_counts[q] -= track_delta
+        split_artist_counts[p] += artist_delta
+        split_artist_counts[q] -= artist_delta
+
+        new_cost = _split_cost(split_artist_counts, split_track_counts)
+        # Temperature decreases geometrically from ANNEAL_TEMPERATURE[0] to ANNEAL_TEMPERATURE[1]
+        temperature = ANNEAL_TEMPERATURE[0] * (ANNEAL_TEMPERATURE[1] / ANNEAL_TEMPERATURE[0]) ** (step / steps)
+        if new_cost <= cost or rng.random() < math.exp((cost - new_cost) / temperature):
+            splits[a], splits[b] = q, p
+            cost = new_cost
+            if cost < best_cost:
+                best_cost, best_splits = cost, splits.copy()
+        else:
+            split_track_counts[p] -= track_delta
+            split_track_counts[q] += track_delta
+            split_artist_counts[p] -= artist_delta
+            split_artist_counts[q] += artist_delta
+
+    log.debug("Annealing stopped after %s steps with cost %.2f", tried, best_cost)
+    return {artist: PARTS[i] for artist, i in zip(artists, best_splits)}
+
+
+def discard_tags_by_count(split_artist_counts, split_track_counts):
+    """Mask of tags below the minimum artist or track count in any of train/test/validation. Counts are
+    (split x tag) matrices with splits in the order of PARTS"""
+    artist_threshold = np.array([config['artist_threshold'][part] for part in PARTS])[:, np.newaxis]
+    track_threshold = np.array([config['track_threshold'][part] for part in PARTS])[:, np.newaxis]
+
+    discard_artist = (split_artist_counts < artist_threshold).any(axis=0)
+    discard_track = (split_track_counts < track_threshold).any(axis=0)
+
+    # Tags that don't appear in all splits are removed too, so that all splits have the same tags (this only
+    # matters when a threshold is 0)
+    discard_missing = (split_track_counts == 0).any(axis=0)
+
+    return discard_artist | discard_track | discard_missing
+
+
+def _split_counts(artist_splits):
+    """Artist and track counts of each tag in train/test/validation, artists missing from the split are not counted"""
+    splits = np.array([artist_splits.get(artist) for artist in trial_data['artists']])
+    assignment = np.array([splits == part for part in PARTS], dtype=np.float64)  # (split x artist)
+    return assignment @ trial_data['tag_presence'], assignment @ trial_data['tag_counts']
+
+
+def evaluate_split(artist_splits, trialnumber):
+    """Tags that have to be discarded for a split of artists, computed from the precomputed artist x tag counts"""
+    discard = discard_tags_by_count(*_split_counts(artist_splits))
+    discarded_tags = {tag for tag, discarded in zip(trial_data['tags'], discard) if discarded}
+
+    original_number_tags = len(trial_data['tags'])
+    final_number_tags = original_number_tags - len(discarded_tags)
+    original_genres, original_moods, original_instruments = trial_data['tags_by_category']
+    remove_genres, remove_moods, remove_instruments = _tags_by_category(discarded_tags)
     log.debug("%s genres out of %s", len(original_genres) - len(remove_genres), len(original_genres))
     log.debug("%s mood/themes out of %s", len(original_moods) - len(remove_moods), len(original_moods))
     log.debug("%s instruments out of %s", len(original_instruments) - len(remove_instruments), len(original_instruments))
 
-    log.debug("Trial %s: Keeping %s tags out of %s; discarded %s tags: %s", 
-              trialnumber, final_number_tags, original_number_tags, 
+    log.debug("Trial %s: Keeping %s tags out of %s; discarded %s tags: %s",
+              trialnumber, final_number_tags, original_number_tags,
               len(discarded_tags), sorted(list(discarded_tags)))
-
-    return train, test, validation, discarded_tags
+    return discarded_tags
 
 
-def _get_all_tags_in_gt(groundtruth):
-    tags = set()
-    for k, v in groundtruth.items():
-        tags.update(v)
-    return tags
+def split_groundtruth(groundtruth, track_to_artist, artist_splits):
+    """Splits tracks of the groundtruth into train/test/validation according to the split of their artists"""
+    parts = {part: {} for part in PARTS}
+    for trackid, tags in groundtruth.items():
+        parts[artist_splits[track_to_artist[trackid]]][trackid] = tags
+    return parts[TRAIN], parts[TEST], parts[VALIDATION]
 
 
 def remove_tags_from_groundtruth(groundtruth, tags, tag_to_tracks):
@@ -297,8 +391,8 @@ def remove_tags_from_groundtruth(groundtruth, tags, tag_to_tracks):
     which tracks to remove tags from. If a track has no more tags, remove it
     from the groundtruth
     """
-    # We don't want to change the original dict as it is used in all interations
-    groundtruth = copy.deepcopy(groundtruth)
+    # We don't want to change the original dict and tag sets as they are shared by all splits
+    groundtruth = {trackid: set(track_tags) for trackid, track_tags in groundtruth.items()}
 
     log.debug("Removing %s tags from groundtruth", len(tags))
 
@@ -325,9 +419,127 @@ def remove_tags_from_groundtruth(groundtruth, tags, tag_to_tracks):
     return groundtruth
 
 
+def _artists_file(splitdir, gt_name, gt_ext):
+    return os.path.join(splitdir, "%s-artists%s" % (gt_name, gt_ext))
+
+
+def _load_split(splitdir, gt_name, gt_ext):
+    """Partition of each artist and tags of each track in the existing files of a split. Splits written before the
+    partition of artists was stored only have the artists of their tracks"""
+    artist_splits = {}
+    split_tracks = {}
+    artists_file = _artists_file(splitdir, gt_name, gt_ext)
+    if os.path.isfile(artists_file):
+        with open(artists_file, newline='') as fp:
+            artist_splits.update({row[0]: row[1] for row in list(csv.reader(fp, delimiter="\t"))[1:]})
+    else:
+        log.debug("No %s, artists without tracks in the split will be placed again", artists_file)
+    for part in PARTS:
+        part_file = os.path.join(splitdir, "%s-%s%s" % (gt_name, part, gt_ext))
+        if not os.path.isfile(part_file):
+            raise FileNotFoundError("Missing split file %s, incremental update needs all train/test/validation files"
+                                    % part_file)
+        groundtruth, _, track_to_artist, _, _ = _load_groundtruth(part_file)
+        artist_splits.update({artist: part for artist in track_to_artist.values() if artist not in artist_splits})
+        split_tracks.update(groundtruth)
+    return artist_splits, split_tracks
+
+
+def place_new_artists(artist_splits):
+    """Assigns artists missing from the split, one at a time, to the partition where they reduce the most the
+    discarded tags and their shortfall from the thresholds, or else to the partition furthest below its ratio"""
+    artists = trial_data['artists']
+    tag_counts = trial_data['tag_counts']
+    tag_presence = trial_data['tag_presence']
+    artist_splits = dict(artist_splits)
+    split_artist_counts, split_track_counts = _split_counts(artist_splits)
+    artists_per_part = np.array([list(artist_splits.values()).count(part) for part in PARTS], dtype=np.float64)
+    ratio = np.array([config['split_ratio'][part] / 100. for part in PARTS])
+
+    new_artists = [i for i, artist in enumerate(artists) if artist not in artist_splits]
+    for i in new_artists:
+        choices = []
+        for p in range(len(PARTS)):
+            split_track_counts[p] += tag_counts[i]
+            split_artist_counts[p] += tag_presence[i]
+            excess = artists_per_part[p] + 1 - ratio[p] * (artists_per_part.sum() + 1)
+            choices.append((_split_cost(split_artist_counts, split_track_counts), excess, p))
+            split_track_counts[p] -= tag_counts[i]
+            split_artist_counts[p] -= tag_presence[i]
+
+        _, _, p = min(choices)
+        split_track_counts[p] += tag_counts[i]
+        split_artist_counts[p] += tag_presence[i]
+        artists_per_part[p] += 1
+        artist_splits[artists[i]] = PARTS[p]
+
+    log.debug("Placed %s artists missing from the split: %s train, %s test, %s validation", len(new_artists),
+              *[sum(artist_splits[artists[i]] == part for i in new_artists) for part in PARTS])
+    return artist_splits
+
+
+def update_splits(groundtruthfile, splits_dir):
+    """Updates existing splits for a new version of the ground-truth. Artists already in a split keep their partition,
+    new artists are placed with `place_new_artists`. Only tags of new or changed tracks are checked against the
+    thresholds again, other tags stay kept or discarded as they were, and only changed files are rewritten"""
+    groundtruth, groundtruth_meta, track_to_artist, artist_to_tracks, header = _load_groundtruth(groundtruthfile)
+    gt_name, gt_ext = os.path.splitext(os.path.basename(groundtruthfile))
+
+    tag_to_tracks = collections.defaultdict(list)
+    for trackid, tags in groundtruth.items():
+        for t in tags:
+            tag_to_tracks[t].append(trackid)
 
-def main(groundtruthfile):
-    run_trials(groundtruthfile)
+    artists = list(artist_to_tracks.keys())
+    tags = list(tag_to_tracks.keys())
+    _init_trials(dict(config), artists, tags, _build_tag_counts(groundtruth, track_to_artist, artists, tags))
+
+    splits = []
+    kept_tags = set()
+    affected_tags = set()
+    for i in range(config['splits']):
+        splitdir = os.path.join(splits_dir, "split-%s" % i)
+        artist_splits, split_tracks = _load_split(splitdir, gt_name, gt_ext)
+        split_tags = set().union(*split_tracks.values())
+        kept_tags |= split_tags
+
+        # Tracks of new artists, tracks whose kept tags changed and removed tracks
+        for trackid, track_tags in groundtruth.items():
+            if track_to_artist[trackid] not in artist_splits \
+                    or split_tracks.get(trackid, set()) != track_tags & split_tags:
+                affected_tags |= track_tags
+            # Tags discarded in the split may be new to the track, which the split files cannot tell. They are checked
+            # again, an unchanged tag keeps the same counts and stays discarded
+            affected_tags |= track_tags - split_tags
+        for trackid, track_tags in split_tracks.items():
+            if trackid not in groundtruth:
+                affected_tags |= track_tags
+        splits.append((splitdir, place_new_artists(artist_splits)))
+
+    # Affected tags have to pass the thresholds in all splits, so that all splits keep having the same tags
+    failed_tags = set()
+    for _, artist_splits in splits:
+        discard = discard_tags_by_count(*_split_counts(artist_splits))
+        failed_tags |= {tag for tag, discarded in zip(tags, discard) if discarded}
+    discarded_tags = (set(tags) - kept_tags - affected_tags) | (affected_tags & failed_tags)
+
+    log.debug("Checked %s affected tags: %s newly kept, %s newly discarded", len(affected_tags),
+              len(affected_tags - failed_tags - kept_tags), len(affected_tags & failed_tags & kept_tags))
+    log.debug("Discarded %s tags: %s", len(discarded_tags), sorted(list(discarded_tags)))
+
+    for splitdir, artist_splits in splits:
+        parts = split_groundtruth(groundtruth, track_to_artist, artist_splits)
+        parts = [remove_tags_from_groundtruth(part, discarded_tags, tag_to_tracks) for part in parts]
+        # Artists no longer in the ground-truth are not kept
+        artist_splits = {artist: artist_splits[artist] for artist in artists}
+        write_split(splitdir, gt_name, gt_ext, header, groundtruth_meta, parts, artist_splits, only_changed=True)
+
+
+def main(groundtruthfile, splits_dir=None):
+    if splits_dir is not None:
+        update_splits(groundtruthfile, splits_dir)
+    else:
+        run_trials(groundtruthfile)
 
 
 if __name__ == "__main__":
@@ -342,12 +554,31 @@ fall into the same split.
                         help='Required number of splits (default 5)')
     parser.add_argument('--trials', default=500,
                         help='Number of random split attempts to select best splits (default 500)')
+    parser.add_argument('--search', default='random', choices=['random', 'anneal'],
+                        help='How each split attempt is made: "random" shuffles artists, "anneal" then improves the '
+                             'shuffle by swapping artists between partitions with simulated annealing '
+                             '(default random)')
+    parser.add_argument('--anneal-steps', default=20000,
+                        help='Maximum number of artist swaps tried per split attempt with --search anneal '
+                             '(default 20000)')
+    parser.add_argument('--time-budget', default=None,
+                        help='Maximum time in seconds spent annealing each split attempt (default: no limit, '
+                             'results then only depend on the seed)')
     parser.add_argument('--split-ratio', default="60-20-20",
                         help='Train/test/validation split ratio (default "60-20-20")')
     parser.add_argument('--artist-threshold', default="10-5-5",
                         help='Minimum amount of artists that each tag should have in train/test/validation splits (default "10-5-5")')
     parser.add_argument('--track-threshold', default="40-20-20",
                         help='Minimum amount of tracks that each tag should have in train/test/validation splits (default "40-20-20")')
+    parser.add_argument('--seed', default=None,
+                        help='Seed for the random split attempts, trial N uses "SEED-N" (default: random)')
+    parser.add_argument('--update', default=None, metavar='SPLITS_DIR',
+                        help='Update the existing splits in SPLITS_DIR/split-N (e.g. data/splits) for a new version '
+                             'of the ground-truth file instead of making new ones: artists keep their partition and '
+                             'only new artists are placed')
+    parser.add_argument('--jobs', default=1,
+                        help='Number of processes to run split attempts in parallel, results do not depend on it '
+                             '(default 1)')
 
     args = parser.parse_args()
 
@@ -374,5 +605,10 @@ fall into the same split.
 
     config['splits'] = int(args.splits)
     config['trials'] = int(args.trials)
+    config['seed'] = args.seed if args.seed is not None else random.randrange(2 ** 32)
+    config['jobs'] = int(args.jobs)
+    config['search'] = args.search
+    config['anneal_steps'] = int(args.anneal_steps)
+    config['time_budget'] = float(args.time_budget) if args.time_budget is not None else None
 
-    main(args.groundtruthfile)
+    main(args.groundtruthfile, args.update)
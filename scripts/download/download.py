@@ -1,11 +1,19 @@
 import argparse
 import csv
+import errno
 import hashlib
+import json
 import os.path
+import re
 import shutil
 import sys
 import tarfile
 import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
 from pathlib import Path
 
 import gdown
@@ -14,53 +22,366 @@ from tqdm import tqdm
 
 base_path = Path(__file__).parent
 ID_FILE_PATH = (base_path / "../../data/download/").resolve()
+DATA_PATH = (base_path / "../../data/").resolve()
+sys.path.append(str((base_path / '..').resolve()))
+import commons
+
+# Metadata of the tracks of each dataset, used to select tracks by tags
+dataset_metadata = {'raw_30s': 'autotagging.tsv', 'autotagging_moodtheme': 'autotagging_moodtheme.tsv'}
+# Extension of the files of each data type, replacing .mp3 of the paths in the metadata
+track_extensions = {'audio': '.mp3', 'audio-low': '.low.mp3', 'melspecs': '.npy', 'acousticbrainz': '.json'}
+
+DATASETS = ['raw_30s', 'autotagging_moodtheme']
+DATA_TYPES = ['audio', 'audio-low', 'melspecs', 'acousticbrainz']
 
 download_from_names = {'gdrive': 'GDrive', 'mtg': 'MTG', 'mtg-fast': 'MTG Fast mirror'}
+mirror_urls = {'mtg': 'https://essentia.upf.edu/documentation/datasets/mtg-jamendo/',
+               'mtg-fast': 'https://cdn.freesound.org/mtg-jamendo/'}
 
 CHUNK_SIZE = 512 * 1024  # 512KB
+HASH_BLOCK_SIZE = 4 * 1024 * 1024  # 4MB
+HASH_CACHE_FILE = '.sha256_verified.json'
+DOWNLOAD_JOBS = 4
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_TIMEOUT = 60  # seconds without receiving data
+BACKOFF = 2  # seconds, doubled after every failed attempt
 
 
-def compute_sha256(filename):
+def update_sha256(sha256, filename, size=None):
+    """Updates the hash with the contents of the file (or its first `size` bytes), read in blocks"""
     with open(filename, 'rb') as f:
-        contents = f.read()
-        checksum = hashlib.sha256(contents).hexdigest()
-        return checksum
+        remaining = size
+        while remaining is None or remaining > 0:
+            block = f.read(HASH_BLOCK_SIZE if remaining is None else min(HASH_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            sha256.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return sha256
 
 
-def download_from_mtg(url, output):
-    output_path = Path(output)
-
-    print('Downloading...', file=sys.stderr)
-    print('From:', url, file=sys.stderr)
-    print('To:', output_path, file=sys.stderr)
+def compute_sha256(filename):
+    return update_sha256(hashlib.sha256(), filename).hexdigest()
 
-    res = requests.get(url, stream=True)
 
+def read_hash_cache(output_dir):
+    """Checksums of files already verified in the output directory, with their size and mtime when verified"""
     try:
-        total = res.headers.get('Content-Length')
-        if total is not None:
-            total = int(total)
-        with tempfile.NamedTemporaryFile(
-            prefix=output_path.name,
-            dir=output_path.parent,
-            delete=False,
-        ) as tmp_file_d:
-            tmp_file = tmp_file_d.name
-            with tqdm(total=total, unit='B', unit_scale=True) as progressbar:
-                for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
-                    tmp_file_d.write(chunk)
-                    progressbar.update(len(chunk))
-        shutil.move(tmp_file_d.name, output)
-    finally:
+        with open(os.path.join(output_dir, HASH_CACHE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_hash_cache(output_dir, hash_cache):
+    with tempfile.NamedTemporaryFile('w', dir=output_dir, delete=False) as f:
+        json.dump(hash_cache, f)
+    os.replace(f.name, os.path.join(output_dir, HASH_CACHE_FILE))
+
+
+def add_hash(hash_cache, output_dir, filename, sha256):
+    stat = os.stat(os.path.join(output_dir, filename))
+    hash_cache[filename] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': sha256}
+
+
+def verify_files(output_dir, filenames, sha256s, hash_cache, jobs=None):
+    """Names of the files that match their checksum. Files are hashed in parallel processes, except those in the
+    hash cache with the same size and mtime, and the cache is updated with the files that match"""
+    to_hash = []
+    valid = []
+    for filename in filenames:
+        stat = os.stat(os.path.join(output_dir, filename))
+        entry = hash_cache.get(filename)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            if entry['sha256'] == sha256s[filename]:
+                valid.append(filename)
+                continue
+        to_hash.append(filename)
+
+    if to_hash:
+        print('Verifying %d existing files' % len(to_hash))
+        with ProcessPoolExecutor(jobs) as executor:
+            checksums = executor.map(compute_sha256, [os.path.join(output_dir, filename) for filename in to_hash])
+            for filename, checksum in zip(to_hash, checksums):
+                if checksum == sha256s[filename]:
+                    add_hash(hash_cache, output_dir, filename, checksum)
+                    valid.append(filename)
+        write_hash_cache(output_dir, hash_cache)
+    return valid
+
+
+def read_tracks(dataset, tsv_files=None, tags_file=None):
+    """Paths of the tracks in the metadata TSV files (or all tracks of the dataset) that have any of the tags of the
+    tags file (if given)"""
+    tsv_files = tsv_files or [os.path.join(DATA_PATH, dataset_metadata[dataset])]
+    tracks = set()
+    for tsv_file in tsv_files:
+        metadata = commons.read_metadata(tsv_file)
+        if tags_file is not None:
+            from filter_subset import filter_subset, read_tags_file
+            metadata = filter_subset(metadata, read_tags_file(tags_file))
+        tracks.update(metadata.paths)
+    return tracks
+
+
+def get_folder(filename):
+    """Folder of the tracks in a tar archive, e.g. 63 for raw_30s_audio-63.tar or raw_30s_acousticbrainz-63.tar.gz"""
+    match = re.search(r'-(\d+)\.tar(\.gz)?$', filename)
+    if match is None:
+        raise ValueError('Unexpected archive name: %s' % filename)
+    return match.group(1)
+
+
+def select_tars(tracks, sha256_tars, data_type):
+    """Names of the files of the tracks for the data type, and the archives that contain them"""
+    names = {track[:-len('.mp3')] + track_extensions[data_type] for track in tracks}
+    folders = {name.split('/')[0] for name in names}
+    return names, [filename for filename in sha256_tars if get_folder(filename) in folders]
+
+
+# Checksums of the tracks and tracks to extract for extract_tar, set once per process by _init_extract
+extract_config = {}
+
+
+def _init_extract(sha256_tracks, members=None):
+    extract_config.update(sha256_tracks=sha256_tracks, members=members)
+
+
+def extract_tar(tar_file, output_dir, remove_tar=False):
+    """Extracts the tracks of a tar archive reading it once as a stream. Each track is hashed while it is written to
+    a temporary file, which is only moved in place if it matches its checksum. Archives can be compressed
+    (acousticbrainz). Returns the names of the tracks"""
+    sha256_tracks = extract_config.get('sha256_tracks')
+    members = extract_config.get('members')
+    tracks = []
+    with tarfile.open(tar_file, 'r|*') as tar:
+        for member in tar:
+            output = os.path.join(output_dir, member.name)
+            if os.path.isabs(member.name) or '..' in member.name.split('/'):
+                raise Exception('Unsafe path in %s: %s' % (tar_file, member.name))
+            if member.isdir():
+                os.makedirs(output, exist_ok=True)
+                continue
+            if not member.isfile() or (members is not None and member.name not in members):
+                continue
+
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+            sha256 = hashlib.sha256()
+            src = tar.extractfile(member)
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(output), delete=False) as f:
+                for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                    f.write(chunk)
+                    sha256.update(chunk)
+
+            if sha256_tracks is not None and sha256.hexdigest() != sha256_tracks.get(member.name):
+                os.remove(f.name)
+                print('%s does not match the checksum' % output, file=sys.stderr)
+                raise Exception('Corrupt file in the dataset: %s' % output)
+            os.replace(f.name, output)
+            os.chmod(output, member.mode & 0o777)
+            os.utime(output, (member.mtime, member.mtime))
+            tracks.append(member.name)
+
+    if remove_tar:
+        os.remove(tar_file)
+    return tracks
+
+
+def get_url(base_url, dataset, data_type, filename):
+    """URL of a file in a mirror, all mirrors have the same layout"""
+    return base_url.rstrip('/') + '/%s/%s/%s' % (dataset, data_type, filename)
+
+
+def get_cache_file(cache_dir, sha256):
+    """Location of a file in the content-addressed cache, named after its SHA-256"""
+    return os.path.join(cache_dir, sha256[:2], sha256)
+
+
+def link_or_copy(src, dst):
+    """Hard-links src to dst, or copies it if they are on different file systems. dst is replaced atomically, through
+    a temporary file with a unique name as several downloads can share the cache"""
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(dst), prefix='.' + os.path.basename(dst) + '.')
+    os.close(fd)
+    try:
+        # os.link does not replace the empty temporary file, which is only reserving the name
+        os.remove(tmp_file)
         try:
+            os.link(src, tmp_file)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copyfile(src, tmp_file)
+        os.replace(tmp_file, dst)
+    finally:
+        # Also left if dst was already a link to src, renaming a link onto the same file does nothing
+        if os.path.lexists(tmp_file):
             os.remove(tmp_file)
-        except OSError:
-            pass
-
-    return output
 
 
-def download(dataset, data_type, download_from, output_dir, unpack_tars, remove_tars):
+def add_to_cache(cache_dir, filename, sha256):
+    """Adds a verified file to the cache, if it is not there yet"""
+    cache_file = get_cache_file(cache_dir, sha256)
+    if not os.path.exists(cache_file):
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        link_or_copy(filename, cache_file)
+
+
+def read_tar_checksums():
+    """SHA-256 of the archives of all datasets and data types, by their path in the mirrors"""
+    sha256s = {}
+    for dataset in DATASETS:
+        for data_type in DATA_TYPES:
+            file_sha256_tars = os.path.join(ID_FILE_PATH, dataset + '_' + data_type + '_sha256_tars.txt')
+            if os.path.exists(file_sha256_tars):
+                with open(file_sha256_tars) as f:
+                    for row in csv.reader(f, delimiter=' '):
+                        sha256s['%s/%s/%s' % (dataset, data_type, row[1])] = row[0]
+    return sha256s
+
+
+def serve(cache_dir, host, port):
+    """Serves the archives in the cache with the same URLs as MTG mirrors (e.g. /raw_30s/audio/raw_30s_audio-00.tar),
+    supporting Range requests so that downloads can be resumed"""
+    sha256s = read_tar_checksums()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_HEAD(self):
+            self.send_file(head=True)
+
+        def do_GET(self):
+            self.send_file()
+
+        def send_file(self, head=False):
+            sha256 = sha256s.get(unquote(self.path.split('?')[0]).strip('/'))
+            cache_file = get_cache_file(cache_dir, sha256) if sha256 is not None else None
+            if cache_file is None or not os.path.exists(cache_file):
+                self.send_error(404)
+                return
+
+            size = os.path.getsize(cache_file)
+            start, end = 0, size - 1
+            match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range', ''))
+            if match and match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), end) if match.group(2) else end
+                if start >= size or end < start:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */%d' % size)
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/x-tar')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            if head:
+                return
+
+            with open(cache_file, 'rb') as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    block = f.read(min(CHUNK_SIZE, remaining))
+                    if not block:
+                        break
+                    self.wfile.write(block)
+                    remaining -= len(block)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print('Serving %s on http://%s:%d/ (use it with --url)' % (cache_dir, host, port))
+    server.serve_forever()
+
+
+class Progress:
+    """Aggregate progress bar of several downloads running in parallel, the total grows as their sizes are known"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.progressbar = tqdm(total=0, unit='B', unit_scale=True)
+
+    def add_total(self, size):
+        with self.lock:
+            self.progressbar.total += size
+            self.progressbar.refresh()
+
+    def update(self, size):
+        with self.lock:
+            self.progressbar.update(size)
+
+    def write(self, message):
+        with self.lock:
+            self.progressbar.write(message, file=sys.stderr)
+
+    def close(self):
+        self.progressbar.close()
+
+
+def download_from_mtg(url, output, progress=None, retries=DOWNLOAD_RETRIES):
+    """Downloads the url to a partial file next to the output, moved to the output once complete. Failed transfers
+    are retried with exponential backoff, resuming with a Range request from the data already received, which is
+    also kept between runs. Returns the SHA-256 of the file, computed while it is downloaded"""
+    part_file = output + '.part'
+    own_progress = progress is None
+    if own_progress:
+        print('Downloading...', file=sys.stderr)
+        print('From:', url, file=sys.stderr)
+        print('To:', Path(output), file=sys.stderr)
+        progress = Progress()
+
+    counted = False
+    sha256, hashed = hashlib.sha256(), 0
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        if hashed != offset:
+            # Data received by a previous run is hashed from disk, only once
+            sha256, hashed = update_sha256(hashlib.sha256(), part_file, offset), offset
+        headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as res:
+                if res.status_code == 416:
+                    # The partial file is already complete
+                    break
+                res.raise_for_status()
+                if res.status_code != 206 and offset:
+                    # The server ignored the Range header, start from zero
+                    if counted:
+                        progress.update(-offset)
+                    offset = 0
+                    sha256, hashed = hashlib.sha256(), 0
+
+                if not counted:
+                    length = res.headers.get('Content-Length')
+                    progress.add_total(offset + int(length) if length is not None else 0)
+                    progress.update(offset)
+                    counted = True
+
+                with open(part_file, 'ab' if offset else 'wb') as f:
+                    for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                        sha256.update(chunk)
+                        hashed += len(chunk)
+                        progress.update(len(chunk))
+            break
+        except (requests.RequestException, OSError) as e:
+            if attempt == retries:
+                if own_progress:
+                    progress.close()
+                raise
+            progress.write('%s: %s, retrying in %ds' % (Path(output).name, e, BACKOFF * 2 ** attempt))
+            time.sleep(BACKOFF * 2 ** attempt)
+
+    if own_progress:
+        progress.close()
+    shutil.move(part_file, output)
+    return sha256.hexdigest()
+
+
+def download(dataset, data_type, download_from, output_dir, unpack_tars, remove_tars, jobs=DOWNLOAD_JOBS,
+             base_url=None, tracks=None, only_tracks=False, cache_dir=None):
     if not os.path.exists(output_dir):
         print('Output directory {} does not exist'.format(output_dir), file=sys.stderr)
         return
@@ -78,11 +399,22 @@ def download(dataset, data_type, download_from, output_dir, unpack_tars, remove_
     with open(file_sha256_tars) as f:
         sha256_tars = dict([(row[1], row[0]) for row in csv.reader(f, delimiter=' ')])
 
-    with open(file_sha256_tracks) as f:
-        sha256_tracks = dict([(row[1], row[0]) for row in csv.reader(f, delimiter=' ')])
+    # Not all datasets have checksums of the tracks
+    sha256_tracks = None
+    if os.path.exists(file_sha256_tracks):
+        with open(file_sha256_tracks) as f:
+            sha256_tracks = dict([(row[1], row[0]) for row in csv.reader(f, delimiter=' ')])
 
     # Filenames to download.
-    ids = sha256_tars.keys()
+    ids = list(sha256_tars.keys())
+
+    # Only the archives with the selected tracks, if any
+    names = None
+    if tracks is not None:
+        names, ids = select_tars(tracks, sha256_tars, data_type)
+        if sha256_tracks is not None and names - sha256_tracks.keys():
+            print('%d selected tracks are not in the dataset' % len(names - sha256_tracks.keys()), file=sys.stderr)
+        print('Selected %d tracks in %d of %d archives' % (len(names), len(ids), len(sha256_tars)))
 
     # Google IDs to download.
     if download_from == 'gdrive':
@@ -92,36 +424,67 @@ def download(dataset, data_type, download_from, output_dir, unpack_tars, remove_
                 id, filename = line.split(('   '))[:2]
                 gids[filename] = id
 
-    removed = []
-    for filename in ids:
-        output = os.path.join(output_dir, filename)
-
-        # Download from Google Drive.
-        if os.path.exists(output):
-            print('Skipping %s (file already exists)' % output)
-            continue
-
-        if download_from == 'gdrive':
-            url = 'https://drive.google.com/uc?id=%s' % gids[filename]
-            gdown.download(url, output, quiet=False)
+    base_url = base_url or mirror_urls.get(download_from)
 
-        elif download_from == 'mtg':
-            url = 'https://essentia.upf.edu/documentation/datasets/mtg-jamendo/' \
-                  '%s/%s/%s' % (dataset, data_type, filename)
-            download_from_mtg(url, output)
+    def fetch(filename):
+        """Downloads and validates a file, returns whether it is valid"""
+        output = os.path.join(output_dir, filename)
+        if cache_dir is not None and os.path.exists(get_cache_file(cache_dir, sha256_tars[filename])):
+            # Files in the cache were verified when added
+            link_or_copy(get_cache_file(cache_dir, sha256_tars[filename]), output)
+            progress.write('%s found in the cache' % filename)
+            return sha256_tars[filename]
 
-        elif download_from == 'mtg-fast':
-            url = 'https://cdn.freesound.org/mtg-jamendo/' \
-                  '%s/%s/%s' % (dataset, data_type, filename)
-            download_from_mtg(url, output)
+        try:
+            if download_from == 'gdrive':
+                url = 'https://drive.google.com/uc?id=%s' % gids[filename]
+                gdown.download(url, output, quiet=False)
+                checksum = compute_sha256(output)
+            else:
+                checksum = download_from_mtg(get_url(base_url, dataset, data_type, filename), output, progress)
+        except (requests.RequestException, OSError) as e:
+            progress.write('%s failed: %s' % (filename, e))
+            return None
 
         # Validate the checksum.
-        if compute_sha256(output) != sha256_tars[filename]:
-            print('%s does not match the checksum, removing the file' % output, file=sys.stderr)
-            removed.append(filename)
+        if checksum != sha256_tars[filename]:
+            progress.write('%s does not match the checksum, removing the file' % output)
             os.remove(output)
+            return None
+        progress.write('%s checksum OK' % filename)
+        if cache_dir is not None:
+            add_to_cache(cache_dir, output, checksum)
+        return checksum
+
+    # Files that exist in full are verified (or found in the hash cache) and skipped, partial downloads (.part files)
+    # are resumed
+    hash_cache = read_hash_cache(output_dir)
+    existing = [filename for filename in ids if os.path.exists(os.path.join(output_dir, filename))]
+    verified = set(verify_files(output_dir, existing, sha256_tars, hash_cache))
+    to_download = []
+    for filename in ids:
+        output = os.path.join(output_dir, filename)
+        if filename in verified:
+            print('Skipping %s (file already exists, checksum OK)' % output)
+            if cache_dir is not None:
+                add_to_cache(cache_dir, output, sha256_tars[filename])
         else:
-            print('%s checksum OK' % filename)
+            if filename in existing:
+                print('%s does not match the checksum, downloading it again' % output, file=sys.stderr)
+                os.remove(output)
+            to_download.append(filename)
+
+    checksums = []
+    if to_download:
+        progress = Progress()
+        with ThreadPoolExecutor(jobs) as executor:
+            checksums = list(executor.map(fetch, to_download))
+        progress.close()
+    for filename, checksum in zip(to_download, checksums):
+        if checksum is not None:
+            add_hash(hash_cache, output_dir, filename, checksum)
+    write_hash_cache(output_dir, hash_cache)
+    removed = [filename for filename, checksum in zip(to_download, checksums) if checksum is None]
 
     if removed:
         print('Missing files:', ' '.join(removed))
@@ -132,43 +495,50 @@ def download(dataset, data_type, download_from, output_dir, unpack_tars, remove_
 
     if unpack_tars:
         print('Unpacking tar archives')
+        if sha256_tracks is None:
+            print('No track checksums for %s %s, tracks are not validated' % (dataset, data_type))
 
         tracks_checked = []
-        for filename in ids:
-            output = os.path.join(output_dir, filename)
-            print('Unpacking', output)
-            tar = tarfile.open(output)
-            tracks = tar.getnames()[1:]  # The first element is folder name.
-            tar.extractall(path=output_dir)
-            tar.close()
-
-            # Validate checksums for all unpacked files
-            for track in tracks:
-                trackname = os.path.join(output_dir, track)
-                if compute_sha256(trackname) != sha256_tracks[track]:
-                    print('%s does not match the checksum' % trackname, file=sys.stderr)
-                    raise Exception('Corrupt file in the dataset: %s' % trackname)
-
-            print('%s track checksums OK' % filename)
-            tracks_checked += tracks
-
-            if remove_tars:
-                os.remove(output)
+        members = names if only_tracks else None
+        with ProcessPoolExecutor(jobs, initializer=_init_extract, initargs=(sha256_tracks, members)) as executor:
+            outputs = [os.path.join(output_dir, filename) for filename in ids]
+            for output, tracks in zip(outputs, executor.map(extract_tar, outputs, [output_dir] * len(outputs),
+                                                            [remove_tars] * len(outputs))):
+                status = 'unpacked' if sha256_tracks is None else 'track checksums OK'
+                print('%s %s' % (os.path.basename(output), status))
+                tracks_checked += tracks
 
         # Check if any tracks are missing in the unpacked archives.
-        if set(tracks_checked) != set(sha256_tracks.keys()):
-            raise Exception('Unpacked data contains tracks not present in the checksum files')
+        if sha256_tracks is not None:
+            folders = {get_folder(filename) for filename in ids}
+            expected = {track for track in sha256_tracks if track.split('/')[0] in folders}
+            if members is not None:
+                expected &= members
+            if set(tracks_checked) != expected:
+                raise Exception('Unpacked data contains tracks not present in the checksum files')
 
         print('Unpacking complete')
 
-
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Download the MTG-Jamendo dataset',
+    if sys.argv[1:2] == ['serve']:
+        parser = argparse.ArgumentParser(prog='download.py serve',
+                                         description='Serve the archives of a --cache directory as a mirror for '
+                                                     'download.py --url',
+                                         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        parser.add_argument('cache_dir', help='cache directory')
+        parser.add_argument('--host', default='0.0.0.0', help='address to listen on')
+        parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+        args = parser.parse_args(sys.argv[2:])
+        serve(args.cache_dir, args.host, args.port)
+        sys.exit()
+
+    parser = argparse.ArgumentParser(description='Download the MTG-Jamendo dataset. Run "download.py serve -h" for '
+                                                 'serving a --cache directory as a mirror',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-    parser.add_argument('--dataset', default='raw_30s', choices=['raw_30s', 'autotagging_moodtheme'],
+    parser.add_argument('--dataset', default='raw_30s', choices=DATASETS,
                         help='dataset to download')
-    parser.add_argument('--type', default='audio', choices=['audio', 'audio-low', 'melspecs', 'acousticbrainz'],
+    parser.add_argument('--type', default='audio', choices=DATA_TYPES,
                         help='type of data to download (audio, audio in low quality, mel-spectrograms, AcousticBrainz features)')
     parser.add_argument('--from', default='mtg-fast', choices=['mtg', 'mtg-fast'],
                         dest='download_from',
@@ -178,9 +548,28 @@ if __name__ == '__main__':
     #                    dest='download_from',
     #                    help='download from Google Drive (fast everywhere), MTG (server in Spain, slow), '
     #                         'or fast MTG mirror (Finland)')
+    parser.add_argument('--url', default=None, dest='base_url',
+                        help='base URL of another mirror with the same layout as MTG ones, overrides --from')
+    parser.add_argument('--cache', default=None, dest='cache_dir',
+                        help='directory of archives by SHA-256, shared by several downloads: archives in it are '
+                             'hard-linked (or copied) instead of downloaded, and downloaded archives are added to it')
+    parser.add_argument('--jobs', type=int, default=DOWNLOAD_JOBS,
+                        help='number of files to download or unpack in parallel')
     parser.add_argument('outputdir', help='directory to store the dataset')
     parser.add_argument('--unpack', action='store_true', help='unpack tar archives')
-    parser.add_argument('--remove', action='store_true', help='remove tar archives while unpacking one by one (use to save disk space)')
+    parser.add_argument('--tsv', nargs='+', default=None, metavar='TSV_FILE',
+                        help='only download the archives with the tracks of these metadata files (e.g. a split)')
+    parser.add_argument('--tags', default=None, metavar='TAGS_FILE',
+                        help='only download the archives with tracks that have any of the tags in this file (e.g. '
+                             'data/tags/top50.txt), from the --tsv files or the metadata of the dataset')
+    parser.add_argument('--only-tracks', action='store_true',
+                        help='with --tsv or --tags, only unpack the selected tracks from the archives')
+    parser.add_argument('--remove', action='store_true',
+                        help='remove each tar archive as soon as it is unpacked and validated (use to save disk space)')
 
     args = parser.parse_args()
-    download(args.dataset, args.type, args.download_from, args.outputdir, args.unpack, args.remove)
+    tracks = None
+    if args.tsv is not None or args.tags is not None:
+        tracks = read_tracks(args.dataset, args.tsv, args.tags)
+    download(args.dataset, args.type, args.download_from, args.outputdir, args.unpack, args.remove, args.jobs,
+             args.base_url, tracks, args.only_tracks, args.cache_dir)
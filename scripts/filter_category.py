@@ -5,20 +5,16 @@ import pandas as pd
 import commons
 
 
-def filter_category(tracks, tags, category, tag_file=None):
+def filter_category(metadata, category, tag_file=None):
+    mask = metadata.category_mask(category)
     if tag_file is not None:
-        tag_list = [category + commons.TAG_HYPHEN + tag for tag in tags[category].keys()]
+        tag_list = [tag for tag, selected in zip(metadata.tags, mask) if selected]
         tag_list = pd.DataFrame(tag_list, columns=['tag'])
         tag_list = tag_list.sort_values(by='tag')
         tag_list.to_csv(tag_file, sep='\t', index=False, header=False)
 
-    track_id_sets = [tag_track_ids for tag_track_ids in tags[category].values()]
-    track_ids = set().union(*track_id_sets)
-    tracks_new = {track_id: track for track_id, track in tracks.items() if track_id in track_ids}
-    for track in tracks_new.values():
-        for other_category in set(commons.CATEGORIES) - {category}:
-            track[other_category] = set()
-    return tracks_new
+    # Tracks without tags of the category are removed, tags of other categories are dropped
+    return metadata.select_tags(mask)
 
 
 if __name__ == '__main__':
@@ -30,7 +26,7 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    tracks, tags, extra = commons.read_file(args.tsv_file)
-    tracks_filtered = filter_category(tracks, tags, args.category, args.tag_list)
-    commons.write_file(tracks_filtered, args.output_file, extra)
+    metadata = commons.read_metadata(args.tsv_file)
+    metadata_filtered = filter_category(metadata, args.category, args.tag_list)
+    commons.write_metadata(metadata_filtered, args.output_file)
 
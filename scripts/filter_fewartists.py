@@ -6,13 +6,16 @@ import util
 from filter_subset import filter_subset
 
 
-def filter_tags(tracks, tags, artist_threshold, directory=None):
+def filter_tags(metadata, artist_threshold, directory=None, statistics=None):
     if directory is not None:
         util.mkdir_p(directory)
 
+    if statistics is None:
+        statistics = get_statistics.CategoryStatistics(metadata)
+
     tags_new_all = {}
-    for category in tags:
-        stats, total = get_statistics.get_statistics(category, tracks, tags)
+    for category in metadata.categories:
+        stats, total = statistics.get(category)
         stats_filtered = stats[stats['artists'] >= artist_threshold]
         if directory is not None:
             get_statistics.write_statistics(category, stats_filtered, directory)
@@ -20,7 +23,7 @@ def filter_tags(tracks, tags, artist_threshold, directory=None):
         tags_new_all[category] = set(stats_filtered['tag'])
         print("- {} tags: {} -> {}".format(category, len(stats), len(stats_filtered)))
 
-    filter_subset(tracks, tags_new_all)
+    return filter_subset(metadata, tags_new_all)
 
 
 if __name__ == '__main__':
@@ -32,6 +35,6 @@ if __name__ == '__main__':
                         help='if this argument is set, statistics will be recomputed and written to this directory')
     args = parser.parse_args()
 
-    tracks, tags, extra = commons.read_file(args.tsv_file)
-    filter_tags(tracks, tags, args.artist_threshold, args.stats_directory)
-    commons.write_file(tracks, args.output_file, extra)
+    metadata = commons.read_metadata(args.tsv_file)
+    metadata = filter_tags(metadata, args.artist_threshold, args.stats_directory)
+    commons.write_metadata(metadata, args.output_file)
@@ -16,18 +16,8 @@ def read_tags_file(tsv_file):
     return tags
 
 
-def filter_subset(tracks, tags_subset):
-    tracks_to_delete = []
-    for track_id, track in tracks.items():
-        total_tags = 0
-        for category, tags_new in tags_subset.items():
-            track[category] &= tags_new
-            total_tags += len(track[category])
-        if total_tags == 0:
-            tracks_to_delete.append(track_id)
-
-    for track in tracks_to_delete:
-        tracks.pop(track)
+def filter_subset(metadata, tags_subset):
+    return metadata.select_tags(metadata.subset_mask(tags_subset))
 
 
 if __name__ == '__main__':
@@ -39,7 +29,7 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    tracks, tags, extra = commons.read_file(args.tsv_file)
+    metadata = commons.read_metadata(args.tsv_file)
     tags_subset = read_tags_file(args.tags_file)
-    filter_subset(tracks, tags_subset)
-    commons.write_file(tracks, args.output_file, extra)
+    metadata = filter_subset(metadata, tags_subset)
+    commons.write_metadata(metadata, args.output_file)
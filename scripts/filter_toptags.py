@@ -5,19 +5,17 @@ import get_statistics
 import util
 
 
-def filter_tags(tracks, tags, tag_threshold, directory=None, tags_file=None):
+def filter_tags(metadata, tag_threshold, directory=None, tags_file=None, statistics=None):
     if directory is not None:
         util.mkdir_p(directory)
 
     # TODO: refactor to properly handle and not disconnect category+tag
-    tags_merged = {}
-    tags_with_prefix = {}
-    for category, category_tags in tags.items():
-        tags_merged.update(category_tags)
-        if tags_file is not None:
-            tags_with_prefix.update({tag: category + commons.TAG_HYPHEN + tag for tag in category_tags})
-
-    stats, total = get_statistics.get_statistics('all', tracks, {'all': tags_merged})
+    tags_with_prefix = dict(zip(metadata.tag_names, metadata.tags))
+
+    if statistics is None:
+        statistics = get_statistics.TagStatistics()
+        statistics.update(metadata)
+    stats, total = statistics.get(None)
     stats = stats.sort_values(by='tracks', ascending=False)
     stats_filtered = stats[:tag_threshold]
     if directory is not None:
@@ -28,19 +26,7 @@ def filter_tags(tracks, tags, tag_threshold, directory=None, tags_file=None):
         tag_list.to_csv(tags_file, sep='\t', index=False, header=False)
 
     tags_top = set(stats_filtered['tag'])
-
-    tracks_to_delete = []
-    for track_id, track in tracks.items():
-
-        total_tags = 0
-        for category in commons.CATEGORIES:
-            track[category] &= tags_top
-            total_tags += len(track[category])
-        if total_tags == 0:
-            tracks_to_delete.append(track_id)
-
-    for track in tracks_to_delete:
-        tracks.pop(track)
+    return metadata.select_tags([tag in tags_top for tag in metadata.tag_names])
 
 
 if __name__ == '__main__':
@@ -53,6 +39,6 @@ if __name__ == '__main__':
     parser.add_argument('--tag-list', default=None, help='text file with filtered tags (top-n)')
     args = parser.parse_args()
 
-    tracks, tags, extra = commons.read_file(args.tsv_file)
-    filter_tags(tracks, tags, args.tag_threshold, args.stats_directory, args.tag_list)
-    commons.write_file(tracks, args.output_file, extra)
+    metadata = commons.read_metadata(args.tsv_file)
+    metadata = filter_tags(metadata, args.tag_threshold, args.stats_directory, args.tag_list)
+    commons.write_metadata(metadata, args.output_file)
@@ -1,4 +1,5 @@
 import argparse
+import itertools
 import os
 import util
 
@@ -9,26 +10,184 @@ import commons
 
 
 def get_statistics(category, tracks, tags):
-    data = []
-    total = {'track': set(), 'artist': set(), 'album': set()}
-    for tag, tag_tracks in tags[category].items():
-        row = [tag]
-
-        for collection in ['artist', 'album']:
-            collection_ids = {tracks[track_id][collection + "_id"] for track_id in tag_tracks}
-            total[collection] |= collection_ids
-            row.append(len(collection_ids))
-
-        total['track'] |= tag_tracks
-        row.append(len(tag_tracks))
-        data.append(row)
-
-    data = pd.DataFrame(data, columns=['tag', 'artists', 'albums', 'tracks'])
-    data = data.sort_values(by=['artists', 'albums', 'tracks', 'tag'], ascending=[False, False, False, True])
-    data = data.reset_index(drop=True)
-
-    total_stats = {category: len(collection_ids) for category, collection_ids in total.items()}
-    return data, total_stats
+    """Number of unique artists, albums and tracks per tag of the category, for the dictionaries of
+    `commons.read_file` (see `TagStatistics` for `commons.Metadata`)"""
+    category_tags = tags[category]
+    tag_tracks = np.fromiter(itertools.chain.from_iterable(category_tags.values()), dtype=np.int64)
+    tag_codes = np.repeat(np.arange(len(category_tags)), [len(track_ids) for track_ids in category_tags.values()])
+
+    # Artist and album are looked up once per track rather than once per (tag, track) pair
+    track_ids, rows = np.unique(tag_tracks, return_inverse=True)
+    ids = {'track': track_ids}
+    for collection in ['artist', 'album']:
+        ids[collection] = np.array([tracks[track_id][collection + '_id'] for track_id in track_ids.tolist()],
+                                   dtype=np.int64)
+
+    statistics = TagStatistics()
+    statistics.add([category + commons.TAG_HYPHEN + tag for tag in category_tags], tag_codes, rows.reshape(-1), ids)
+    return statistics.get(category)
+
+
+# Unique ids are found with lookup tables of this many entries at most, and by sorting otherwise
+LOOKUP_SIZE = 2 ** 26
+ID_MASK = 0xffffffff
+
+
+def _sorted_unique(values):
+    values = np.sort(values)
+    return values[np.concatenate(([True], values[1:] != values[:-1]))] if len(values) else values
+
+
+def _encode_ids(ids):
+    """Sorted unique ids and the index of each id in them, or None if ids are too large for a lookup table"""
+    if len(ids) == 0 or ids.max() >= LOOKUP_SIZE:
+        return None
+    present = np.zeros(ids.max() + 1, dtype=bool)
+    present[ids] = True
+    return np.flatnonzero(present), np.cumsum(present)[ids] - 1
+
+
+def _count_unique(ids):
+    encoded = _encode_ids(ids)
+    return len(encoded[0]) if encoded is not None else len(_sorted_unique(ids))
+
+
+def _unique_pairs(tag_codes, ids, n_tags, rows=None):
+    """Unique (tag, id) pairs packed into int64 as tag << 32 | id, using a tag x id table when it is small enough.
+    If `rows` is given, ids are per row and `rows` has the row of each pair"""
+    encoded = _encode_ids(ids)
+    if encoded is None or n_tags * len(encoded[0]) > LOOKUP_SIZE:
+        return _sorted_unique(tag_codes << 32 | (ids[rows] if rows is not None else ids))
+
+    id_values, id_codes = encoded
+    present = np.zeros(n_tags * len(id_values), dtype=bool)
+    present[tag_codes * len(id_values) + (id_codes[rows] if rows is not None else id_codes)] = True
+    pairs = np.flatnonzero(present)
+    return (pairs // len(id_values)) << 32 | id_values[pairs % len(id_values)]
+
+
+class TagStatistics:
+    """Number of unique artists, albums and tracks per tag, accumulated over one or more `commons.Metadata` batches
+    (e.g. streamed with `commons.iter_metadata`), so that the whole file never has to be in memory"""
+
+    COLLECTIONS = ['track', 'artist', 'album']
+
+    def __init__(self):
+        self.tag_index = {}
+        # Unique (tag, id) pairs, packed into int64 as tag << 32 | id, for each collection
+        self.pairs = {collection: [] for collection in self.COLLECTIONS}
+        # While track ids keep increasing, (tag, track) pairs are unique without having to check them
+        self.last_track_id = -1
+        self.increasing_tracks = True
+
+    @property
+    def tags(self):
+        return list(self.tag_index)
+
+    @property
+    def categories(self):
+        return commons.get_categories([tag.split(commons.TAG_HYPHEN)[0] for tag in self.tag_index])
+
+    def update(self, metadata):
+        self.add(metadata.tags, metadata.indices, metadata.tag_rows,
+                 {collection: getattr(metadata, collection + '_ids') for collection in self.COLLECTIONS})
+
+    def add(self, tags, tag_codes, rows, ids):
+        """Adds unique (tag, row) pairs: `tag_codes` are indices into `tags` and `ids` holds the ids of each
+        collection per row"""
+        codes = np.array([self.tag_index.setdefault(tag, len(self.tag_index)) for tag in tags], dtype=np.int64)
+        tag_codes = codes[tag_codes]
+
+        track_ids = ids['track']
+        if len(track_ids):
+            self.increasing_tracks &= bool(track_ids[0] > self.last_track_id and np.all(track_ids[1:] > track_ids[:-1]))
+            self.last_track_id = track_ids[-1]
+
+        for collection in self.COLLECTIONS:
+            if collection == 'track' and self.increasing_tracks:
+                self.pairs[collection].append(tag_codes << 32 | track_ids[rows])
+            else:
+                self.pairs[collection].append(_unique_pairs(tag_codes, ids[collection], len(self.tag_index), rows))
+
+    def get_pairs(self, collection):
+        pairs = self.pairs[collection]
+        if len(pairs) != 1:
+            pairs = np.concatenate(pairs + [np.empty(0, np.int64)])
+            if collection != 'track' or not self.increasing_tracks:
+                pairs = _unique_pairs(pairs >> 32, pairs & ID_MASK, len(self.tag_index))
+            self.pairs[collection] = [pairs]
+        return self.pairs[collection][0]
+
+    def get(self, category=None):
+        """Same output as `get_statistics`, computed over all tags if category is None"""
+        tag_categories, tag_names = zip(*[tag.split(commons.TAG_HYPHEN) for tag in self.tags]) \
+            if self.tag_index else ((), ())
+        mask = np.array([category is None or tag_category == category for tag_category in tag_categories],
+                        dtype=bool)
+
+        data = {'tag': np.array(tag_names, dtype=object)[mask]}
+        total_stats = {}
+        for collection in self.COLLECTIONS:
+            pairs = self.get_pairs(collection)
+            codes = pairs >> 32
+            data[collection + 's'] = np.bincount(codes, minlength=len(mask))[mask]
+            total_stats[collection] = _count_unique(pairs[mask[codes]] & ID_MASK)
+
+        # An empty table has the same (object) columns as one built from an empty list of rows
+        data = pd.DataFrame(data if mask.any() else [], columns=['tag', 'artists', 'albums', 'tracks'])
+        data = data.sort_values(by=['artists', 'albums', 'tracks', 'tag'], ascending=[False, False, False, True])
+        data = data.reset_index(drop=True)
+        return data, total_stats
+
+
+class CategoryStatistics:
+    """Statistics of a `commons.Metadata` computed per category on first use. Statistics of categories that are
+    known not to have changed (e.g. carried over from the input of a filter) can be passed in `statistics`"""
+
+    def __init__(self, metadata, statistics=None):
+        self.metadata = metadata
+        self.statistics = dict(statistics or {})
+
+    @property
+    def categories(self):
+        return self.metadata.categories
+
+    def compute(self, categories):
+        categories = [category for category in categories if category not in self.statistics]
+        if not categories:
+            return
+
+        mask = np.zeros(len(self.metadata.tags), dtype=bool)
+        for category in categories:
+            mask |= self.metadata.category_mask(category)
+        statistics = TagStatistics()
+        statistics.update(self.metadata.select_tags(mask))
+        for category in categories:
+            self.statistics[category] = statistics.get(category)
+
+    def get(self, category=None):
+        """Same output as `TagStatistics.get`"""
+        if category is not None:
+            self.compute([category])
+            return self.statistics[category]
+
+        self.compute(self.categories)
+        frames = [self.statistics[category][0] for category in self.categories]
+        data = pd.concat(frames) if frames else pd.DataFrame(columns=['tag', 'artists', 'albums', 'tracks'])
+        data = data.sort_values(by=['artists', 'albums', 'tracks', 'tag'], ascending=[False, False, False, True])
+        data = data.reset_index(drop=True)
+
+        tagged = np.diff(self.metadata.indptr) > 0
+        total_stats = {collection: len(np.unique(getattr(self.metadata, collection + '_ids')[tagged]))
+                       for collection in TagStatistics.COLLECTIONS}
+        return data, total_stats
+
+
+def get_metadata_statistics(category, metadata):
+    """Same as `get_statistics` for `commons.Metadata`, computed over all tags if category is None"""
+    statistics = TagStatistics()
+    statistics.update(metadata)
+    return statistics.get(category)
 
 
 def write_statistics(category, data, directory):
@@ -36,17 +195,17 @@ def write_statistics(category, data, directory):
     data.to_csv(os.path.join(directory, category.replace('/', '_') + '.tsv'), sep='\t', index=False)
 
 
-def compute_statistics(tracks, tags, directory):
+def compute_statistics(statistics, directory):
     util.mkdir_p(directory)
 
-    for category in tags:
-        data, total = get_statistics(category, tracks, tags)
+    for category in statistics.categories:
+        data, total = statistics.get(category)
         write_statistics(category, data, directory)
         print('Total tags for {}: {} tags, {}'.format(category, len(data), total))
 
 
-def compute_duration_stats(tracks):
-    data = np.array([track['duration'] for track in tracks.values()])
+def compute_duration_stats(durations):
+    data = np.asarray(durations)
     print('Mean: {}, median: {}'.format(data.mean(), np.median(data)))
 
 
@@ -57,6 +216,12 @@ if __name__ == '__main__':
     parser.add_argument('directory', help='directory for computed statistics')
     args = parser.parse_args()
 
-    tracks, tags, _ = commons.read_file(args.tsv_file)
-    compute_duration_stats(tracks)
-    compute_statistics(tracks, tags, args.directory)
+    # Stream the file, only durations and unique (tag, id) pairs are kept in memory
+    statistics = TagStatistics()
+    durations = []
+    for metadata in commons.iter_metadata(args.tsv_file):
+        statistics.update(metadata)
+        durations.append(metadata.durations)
+
+    compute_duration_stats(np.concatenate(durations) if durations else np.empty(0))
+    compute_statistics(statistics, args.directory)
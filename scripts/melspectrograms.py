@@ -1,11 +1,21 @@
 from argparse import ArgumentParser
+import inspect
+import json
+import multiprocessing
+import os
+import tempfile
+import time
 
-from essentia.standard import *
-import essentia
 import numpy
 
+import cache
+import commons
+import util
+
 
 def load_audio(filename, sampleRate=12000, segment_duration=None):
+    # Essentia is imported where it is used, so that the NumPy backend can run without it on audio already loaded
+    from essentia.standard import MonoLoader
     audio = MonoLoader(filename=filename, sampleRate=sampleRate, resampleQuality=4)()
 
     if segment_duration:
@@ -22,61 +32,334 @@ def load_audio(filename, sampleRate=12000, segment_duration=None):
     return audio[segment_start:segment_end]
 
 
-def melspectrogram(audio,
-                   sampleRate=12000, frameSize=512, hopSize=256,
-                   window='hann', zeroPadding=0, center=True,
-                   numberBands=96, lowFrequencyBound=0, highFrequencyBound=None,
-                   weighting='linear', warpingFormula='slaneyMel',
-                   normalize='unit_tri'):
+class MelSpectrogram:
+    """Essentia algorithms for `melspectrogram`, created once and reused for every audio"""
+
+    def __init__(self,
+                 sampleRate=12000, frameSize=512, hopSize=256,
+                 window='hann', zeroPadding=0, center=True,
+                 numberBands=96, lowFrequencyBound=0, highFrequencyBound=None,
+                 weighting='linear', warpingFormula='slaneyMel',
+                 normalize='unit_tri'):
+
+        from essentia.standard import MelBands, Spectrum, UnaryOperator, Windowing
+
+        if highFrequencyBound is None:
+            highFrequencyBound = sampleRate/2
+
+        self.frameSize = frameSize
+        self.hopSize = hopSize
+        self.center = center
+
+        self.windowing = Windowing(type=window, normalized=False, zeroPadding=zeroPadding)
+        self.spectrum = Spectrum()
+        self.melbands = MelBands(numberBands=numberBands,
+                                 sampleRate=sampleRate,
+                                 lowFrequencyBound=lowFrequencyBound,
+                                 highFrequencyBound=highFrequencyBound,
+                                 inputSize=(frameSize+zeroPadding)//2+1,
+                                 weighting=weighting,
+                                 normalize=normalize,
+                                 warpingFormula=warpingFormula,
+                                 type='power')
+        self.amp2db = UnaryOperator(type='lin2db', scale=2)
+
+    def __call__(self, audio):
+        import essentia
+        from essentia.standard import FrameGenerator
+
+        mel = [self.amp2db(self.melbands(self.spectrum(self.windowing(frame))))
+               for frame in FrameGenerator(audio,
+                                           frameSize=self.frameSize, hopSize=self.hopSize,
+                                           startFromZero=not self.center)]
+        return essentia.array(mel).T
+
+
+def hz2mel_slaney(frequency):
+    frequency = numpy.asarray(frequency, dtype=numpy.float64)
+    return numpy.where(frequency < 1000, frequency * 3 / 200,
+                       15 + numpy.log(numpy.maximum(frequency, 1000) / 1000) * 27 / numpy.log(6.4))
+
+
+def mel2hz_slaney(mel):
+    mel = numpy.asarray(mel, dtype=numpy.float64)
+    return numpy.where(mel < 15, mel * 200 / 3, 1000 * numpy.exp((mel - 15) * numpy.log(6.4) / 27))
+
+
+def mel_filterbank(numberBands, sampleRate, lowFrequencyBound, highFrequencyBound, inputSize, normalize):
+    """(inputSize x numberBands) matrix of triangular filters equally spaced in the Slaney mel scale, built as in
+    Essentia's MelBands with linear weighting"""
+    frequencies = mel2hz_slaney(numpy.linspace(hz2mel_slaney(lowFrequencyBound), hz2mel_slaney(highFrequencyBound),
+                                               numberBands + 2))
+    frequency_scale = (sampleRate / 2) / (inputSize - 1)
+    bins = numpy.arange(inputSize) * frequency_scale
+
+    filters = numpy.zeros((inputSize, numberBands))
+    for i in range(numberBands):
+        low, center, high = frequencies[i:i + 3]
+        rising = (bins >= low) & (bins < center)
+        falling = (bins >= center) & (bins < high)
+        filters[rising, i] = (bins[rising] - low) / (center - low)
+        filters[falling, i] = (high - bins[falling]) / (high - center)
 
-    if highFrequencyBound is None:
-        highFrequencyBound = sampleRate/2
+        if normalize == 'unit_tri':
+            filters[:, i] *= 2 / (high - low)
+        elif normalize == 'unit_sum' and filters[:, i].sum() > 0:
+            filters[:, i] /= filters[:, i].sum()
+    return filters
 
-    windowing = Windowing(type=window, normalized=False, zeroPadding=zeroPadding)
-    spectrum = Spectrum()
-    melbands = MelBands(numberBands=numberBands,
-                        sampleRate=sampleRate,
-                        lowFrequencyBound=lowFrequencyBound,
-                        highFrequencyBound=highFrequencyBound,
-                        inputSize=(frameSize+zeroPadding)//2+1,
-                        weighting=weighting,
-                        normalize=normalize,
-                        warpingFormula=warpingFormula,
-                        type='power')
-    amp2db = UnaryOperator(type='lin2db', scale=2)
 
-    pool = essentia.Pool()
-    for frame in FrameGenerator(audio,
-                                frameSize=frameSize, hopSize=hopSize,
-                                startFromZero=not center):
-        pool.add('mel', amp2db(melbands(spectrum(windowing(frame)))))
+class NumpyMelSpectrogram:
+    """Same output as `MelSpectrogram` computed for all frames at once with NumPy: frames are a strided view of the
+    padded audio, followed by a batched real FFT and a matrix product with the filterbank. Values differ by less than
+    0.01 dB, except for bands more than ~150 dB below the loudest ones, where float32 rounding of the FFT dominates.
+    Only the default window, weighting and warping are supported"""
 
-    return pool['mel'].T
+    def __init__(self,
+                 sampleRate=12000, frameSize=512, hopSize=256,
+                 window='hann', zeroPadding=0, center=True,
+                 numberBands=96, lowFrequencyBound=0, highFrequencyBound=None,
+                 weighting='linear', warpingFormula='slaneyMel',
+                 normalize='unit_tri'):
 
+        if window != 'hann' or weighting != 'linear' or warpingFormula != 'slaneyMel':
+            raise ValueError('Only the hann window, linear weighting and slaneyMel warping are supported')
 
-def analyze(audio_file, npy_file, full_audio):
+        if highFrequencyBound is None:
+            highFrequencyBound = sampleRate/2
+
+        self.frameSize = frameSize
+        self.hopSize = hopSize
+        self.center = center
+        self.fftSize = frameSize + zeroPadding
+
+        # Symmetric Hann window, as in Essentia
+        self.window = 0.5 - 0.5 * numpy.cos(2 * numpy.pi * numpy.arange(frameSize) / (frameSize - 1))
+        self.filterbank = mel_filterbank(numberBands, sampleRate, lowFrequencyBound, highFrequencyBound,
+                                         self.fftSize // 2 + 1, normalize).astype(numpy.float32)
+
+    def frames(self, audio):
+        """(frames x frameSize) view of the audio with frames placed as by Essentia's FrameGenerator"""
+        audio = numpy.asarray(audio, dtype=numpy.float32)
+        if self.center:
+            # The first frame is centered on the first sample, and frames continue as long as they start before the
+            # end of the audio
+            start = (self.frameSize + 1) // 2
+            n_frames = (len(audio) + start + self.hopSize - 1) // self.hopSize if len(audio) else 0
+        else:
+            # Frames start at the first sample, the last one is the last frame whose center is in the audio
+            start = 0
+            n_frames = max(1, -(-(len(audio) - self.frameSize // 2) // self.hopSize)) if len(audio) else 0
+
+        padded = numpy.zeros(max((n_frames - 1) * self.hopSize, 0) + self.frameSize, dtype=numpy.float32)
+        end = min(len(audio), len(padded) - start)
+        padded[start:start + end] = audio[:end]
+        return numpy.lib.stride_tricks.sliding_window_view(padded, self.frameSize)[::self.hopSize][:n_frames]
+
+    def __call__(self, audio):
+        frames = self.frames(audio) * self.window
+        spectrum = numpy.abs(numpy.fft.rfft(frames, n=self.fftSize, axis=1)).astype(numpy.float32)
+        mel = (spectrum ** 2) @ self.filterbank
+
+        # Essentia's lin2db (-100 below the silence cutoff of 1e-10) with the output scaled by 2
+        mel_db = numpy.full(mel.shape, -100, dtype=numpy.float32)
+        numpy.log10(mel, out=mel_db, where=mel >= 1e-10)
+        mel_db[mel >= 1e-10] *= 10
+        return 2 * mel_db.T
+
+
+BACKENDS = {
+    'essentia': MelSpectrogram,
+    'numpy': NumpyMelSpectrogram
+}
+
+
+def melspectrogram(audio, backend='essentia', **params):
+    return BACKENDS[backend](**params)(audio)
+
+
+def get_segment_duration(full_audio):
     if full_audio:
       # Analyze full audio duration.
-      segment_duration=None
+      return None
     else:
       # Duration for the Choi's VGG model.
-      segment_duration=29.1
+      return 29.1
+
+
+def analyze(audio_file, npy_file, full_audio, extractor=None):
+    if extractor is None:
+        extractor = MelSpectrogram()
 
-    audio = load_audio(audio_file, segment_duration=segment_duration)
-    mel = melspectrogram(audio)
+    audio = load_audio(audio_file, segment_duration=get_segment_duration(full_audio))
+    mel = extractor(audio)
     numpy.save(npy_file, mel, allow_pickle=False)
     return
 
 
+def get_npy_file(npy_dir, path):
+    """Location of the mel-spectrogram of an audio path (e.g. 14/214.mp3) as read by `baseline/data_loader.py`"""
+    return os.path.join(npy_dir, 'npy', path[:-3] + 'npy')
+
+
+def read_paths(input_file):
+    """Audio paths from a metadata TSV file or from a text file with one path per line"""
+    if input_file.endswith('.tsv'):
+        return list(commons.read_metadata(input_file).paths)
+    with open(input_file) as fp:
+        return [line.strip() for line in fp if line.strip()]
+
+
+MANIFEST_FILE = 'manifest.jsonl'
+
+
+def get_params(full_audio):
+    """Parameters that change the output of the extraction (the backend does not, results are the same within 0.01 dB
+    in both)"""
+    params = {name: parameter.default for name, parameter in inspect.signature(MelSpectrogram).parameters.items()}
+    params['segment_duration'] = get_segment_duration(full_audio)
+    return params
+
+
+def read_manifest(npy_dir):
+    """Latest manifest entry for each audio path. The manifest has one JSON line per processed file with the SHA-256,
+    size and mtime of the source, the extraction parameters, the output file (relative to `npy_dir`) and the status
+    (done or failed)"""
+    manifest = {}
+    try:
+        with open(os.path.join(npy_dir, MANIFEST_FILE)) as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # last line of an interrupted run
+                manifest[entry['path']] = entry
+    except FileNotFoundError:
+        pass
+    return manifest
+
+
+def write_manifest(npy_dir, manifest):
+    """Rewrites the manifest with only the latest entry for each path"""
+    util.mkdir_p(npy_dir)
+    with tempfile.NamedTemporaryFile('w', dir=npy_dir, delete=False) as fp:
+        for entry in manifest.values():
+            fp.write(json.dumps(entry) + '\n')
+    os.replace(fp.name, os.path.join(npy_dir, MANIFEST_FILE))
+
+
+def is_done(entry, audio_file, npy_file, params):
+    """Whether a manifest entry is a finished extraction with the same parameters, and the same source file (if its
+    size or mtime changed, the worker compares the SHA-256)"""
+    if entry is None or entry['status'] != 'done' or entry['params'] != params or not os.path.isfile(npy_file):
+        return False
+    try:
+        stat = os.stat(audio_file)
+    except OSError:
+        return False
+    return entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns
+
+
+# Settings and algorithms of each worker process, set once by _init_worker
+worker = {}
+
+
+def _init_worker(audio_dir, npy_dir, full_audio, backend):
+    worker.update(audio_dir=audio_dir, npy_dir=npy_dir, full_audio=full_audio, extractor=BACKENDS[backend](),
+                  params=get_params(full_audio))
+
+
+def _analyze_path(task):
+    path, entry = task
+    audio_file = os.path.join(worker['audio_dir'], path)
+    npy_file = get_npy_file(worker['npy_dir'], path)
+    result = {'path': path, 'output': os.path.relpath(npy_file, worker['npy_dir']), 'params': worker['params'],
+              'status': 'failed', 'error': None, 'sha256': None, 'size': None, 'mtime': None}
+    try:
+        stat = os.stat(audio_file)
+        result.update(sha256=cache.compute_sha256(audio_file), size=stat.st_size, mtime=stat.st_mtime_ns)
+
+        # Touched but unchanged source files do not need to be analyzed again
+        if entry is not None and entry['status'] == 'done' and entry['sha256'] == result['sha256'] and \
+                entry['params'] == result['params'] and os.path.isfile(npy_file):
+            result['status'] = 'done'
+            return result
+
+        # Write to a temporary file first, so that an interrupted run never leaves a partial output
+        util.mkdir_p(os.path.dirname(npy_file))
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(npy_file), suffix='.npy', delete=False) as fp:
+            tmp_file = fp.name
+        try:
+            analyze(audio_file, tmp_file, worker['full_audio'], worker['extractor'])
+            os.replace(tmp_file, npy_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    except (OSError, RuntimeError, ValueError) as e:
+        result['error'] = str(e)
+        return result
+
+    result['status'] = 'done'
+    return result
+
+
+def analyze_batch(paths, audio_dir, npy_dir, full_audio, jobs, backend='essentia', force=False):
+    """Computes mel-spectrograms of all audio paths (relative to `audio_dir`) in a pool of `jobs` processes. Files that
+    are done according to the manifest in `npy_dir` are skipped, unless `force` is set"""
+    manifest = read_manifest(npy_dir)
+    params = get_params(full_audio)
+    tasks = [(path, manifest.get(path)) for path in paths if force or not is_done(
+             manifest.get(path), os.path.join(audio_dir, path), get_npy_file(npy_dir, path), params)]
+    print('{} files to analyze, {} already done'.format(len(tasks), len(paths) - len(tasks)))
+    write_manifest(npy_dir, manifest)
+
+    start = time.time()
+    errors = []
+    worker_args = (audio_dir, npy_dir, full_audio, backend)
+    with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=worker_args) as pool, \
+            open(os.path.join(npy_dir, MANIFEST_FILE), 'a') as manifest_fp:
+        for done, result in enumerate(pool.imap_unordered(_analyze_path, tasks, chunksize=4), 1):
+            # Every result is recorded as soon as it is known, so that an interrupted run can be resumed
+            manifest_fp.write(json.dumps(result) + '\n')
+            manifest_fp.flush()
+
+            if result['status'] != 'done':
+                errors.append((result['path'], result['error']))
+                print('Failed {}: {}'.format(result['path'], result['error']))
+            if done % 100 == 0 or done == len(tasks):
+                elapsed, remaining = util.stats(done, len(tasks), start)
+                print('{}/{} files, elapsed {}, remaining {}'.format(done, len(tasks), elapsed, remaining))
+    return errors
+
+
 if __name__ == '__main__':
     parser = ArgumentParser(description="Computes a mel-spectrogram for an audio file. Results are stored to a NumPy "
-                                        "array binary file.")
+                                        "array binary file. With --batch, computes mel-spectrograms for all files of "
+                                        "a list in parallel.")
 
-    parser.add_argument('audio_file', help='input audio file')
-    parser.add_argument('npy_file', help='output NPY file to store mel-spectrogram')
+    parser.add_argument('audio_file', help='input audio file (or audio directory with --batch)')
+    parser.add_argument('npy_file', help='output NPY file to store mel-spectrogram (or output directory with --batch, '
+                                         'NPY files are stored in its npy subdirectory as expected by '
+                                         'baseline/data_loader.py)')
     parser.add_argument('--full', dest='full_audio', help='analyze full audio instead of a centered 29.1s segment',
                         action='store_true')
+    parser.add_argument('--backend', choices=BACKENDS.keys(), default='essentia',
+                        help='compute mel bands frame by frame with Essentia, or all frames at once with NumPy '
+                             '(several times faster, same values within 0.01 dB except for near silent bands). Audio '
+                             'files are decoded with Essentia in both')
+    parser.add_argument('--batch', default=None, metavar='INPUT_FILE',
+                        help='metadata TSV file or text file with one audio path per line, relative to audio_file')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='number of processes for --batch (default: number of CPUs)')
+    parser.add_argument('--force', action='store_true',
+                        help='with --batch, analyze all files again, even those done according to the manifest '
+                             '(%s in the output directory)' % MANIFEST_FILE)
     args = parser.parse_args()
 
-    analyze(args.audio_file, args.npy_file, args.full_audio)
-
+    if args.batch is not None:
+        errors = analyze_batch(read_paths(args.batch), args.audio_file, args.npy_file, args.full_audio, args.jobs,
+                               args.backend, args.force)
+        if errors:
+            print('{} files failed'.format(len(errors)))
+    else:
+        analyze(args.audio_file, args.npy_file, args.full_audio, BACKENDS[args.backend]())
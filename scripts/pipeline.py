@@ -0,0 +1,103 @@
+import argparse
+
+import commons
+import get_statistics
+import util
+import filter_fewartists
+import filter_toptags
+from clean_tags import merge_tags
+from filter_category import filter_category
+from filter_subset import filter_subset, read_tags_file
+
+SPEC_DESCRIPTION = '''JSON file with the input TSV file and the list of stages, e.g.
+{"input": "data/raw_30s.tsv",
+ "stages": [
+   {"stage": "clean_tags", "map_file": "data/tag_map.json", "output": "data/raw_30s_cleantags.tsv"},
+   {"stage": "filter_fewartists", "name": "autotagging", "artist_threshold": 50,
+    "stats_directory": "stats/raw_30s_cleantags_50artists", "output": "data/raw_30s_cleantags_50artists.tsv"},
+   {"stage": "filter_toptags", "tag_threshold": 50, "tag_list": "data/tags/tags_top50.txt",
+    "output": "data/autotagging_top50tags.tsv"},
+   {"stage": "filter_category", "from": "autotagging", "category": "mood/theme", "tag_list": "data/tags/moodtheme.txt",
+    "output": "data/autotagging_moodtheme.tsv"}]}
+Parameters of each stage are the arguments of the script with the same name. Every stage takes the output of the
+previous one, or of the stage given by "from" ("name" of an earlier stage). "output" (TSV file) and "statistics"
+(directory for the same statistics as get_statistics.py) are optional for all stages.'''
+
+
+def _category_tags(metadata, category):
+    return {tag for tag, selected in zip(metadata.tag_names, metadata.category_mask(category)) if selected}
+
+
+def _changed_categories(metadata, metadata_new):
+    """Categories whose set of tags changed, which for stages that only remove tags means their tracks changed too"""
+    return {category for category in set(metadata.categories) | set(metadata_new.categories)
+            if _category_tags(metadata, category) != _category_tags(metadata_new, category)}
+
+
+def run_stage(stage, metadata, statistics):
+    """Runs a stage on the metadata, returns the new metadata and the categories it changed"""
+    params = {key: value for key, value in stage.items() if key not in ['stage', 'name', 'from', 'output', 'statistics']}
+    name = stage['stage']
+
+    if name == 'clean_tags':
+        tag_map = util.read_json(params['map_file'])
+        metadata_new = merge_tags(metadata, tag_map)
+        # Renaming can move tracks between tags and keep the same set of tags, so all categories with a mapped tag
+        # that is present are considered changed
+        changed = {category for category in metadata.categories
+                   if set(tag_map.get(category, {})) & _category_tags(metadata, category)}
+        return metadata_new, changed | _changed_categories(metadata, metadata_new)
+
+    if name == 'filter_fewartists':
+        metadata_new = filter_fewartists.filter_tags(metadata, params['artist_threshold'],
+                                                     params.get('stats_directory'), statistics)
+    elif name == 'filter_toptags':
+        metadata_new = filter_toptags.filter_tags(metadata, params['tag_threshold'], params.get('stats_directory'),
+                                                  params.get('tag_list'), statistics)
+    elif name == 'filter_category':
+        metadata_new = filter_category(metadata, params['category'], params.get('tag_list'))
+    elif name == 'filter_subset':
+        metadata_new = filter_subset(metadata, read_tags_file(params['tags_file']))
+    else:
+        raise ValueError('Unknown stage {}, should be one of clean_tags, filter_fewartists, filter_toptags, '
+                         'filter_category, filter_subset'.format(name))
+    return metadata_new, _changed_categories(metadata, metadata_new)
+
+
+def run_pipeline(spec, tsv_file=None):
+    """Runs all stages of the spec over the metadata loaded once, returns the metadata of every named stage"""
+    metadata = commons.read_metadata(tsv_file or spec['input'])
+    statistics = get_statistics.CategoryStatistics(metadata)
+
+    results = {}
+    for i, stage in enumerate(spec['stages']):
+        if 'from' in stage:
+            metadata, statistics = results[stage['from']]
+        print('Stage {}: {}'.format(i, stage['stage']))
+
+        metadata_new, changed = run_stage(stage, metadata, statistics)
+        # Statistics of categories the stage did not change are still valid
+        statistics = get_statistics.CategoryStatistics(metadata_new, {
+            category: category_statistics for category, category_statistics in statistics.statistics.items()
+            if category not in changed and category in metadata_new.categories})
+        metadata = metadata_new
+        results[stage.get('name', i)] = metadata, statistics
+
+        if 'statistics' in stage:
+            get_statistics.compute_statistics(statistics, stage['statistics'])
+        if 'output' in stage:
+            commons.write_metadata(metadata, stage['output'])
+
+    return {name: metadata for name, (metadata, _) in results.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs clean_tags, filter_fewartists, filter_toptags, filter_category '
+                                                 'and filter_subset stages in a single process, reading the metadata '
+                                                 'only once', formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog=SPEC_DESCRIPTION)
+    parser.add_argument('spec_file', help='JSON file with the list of stages (see below)')
+    parser.add_argument('--input', default=None, help='input TSV file, overrides "input" of the spec')
+    args = parser.parse_args()
+
+    run_pipeline(util.read_json(args.spec_file), args.input)
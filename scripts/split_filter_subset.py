@@ -1,12 +1,42 @@
 import argparse
+import multiprocessing
+import time
 from pathlib import Path
 
+import numpy as np
+
 import commons
 from filter_subset import filter_subset, read_tags_file
 from filter_category import filter_category
 
 PARTS = ['train', 'test', 'validation']
 
+# Filter settings shared by all files, set once per process by _init_filter
+filter_config = {}
+
+
+def _init_filter(tags_subset, category, sort):
+    filter_config.update(tags_subset=tags_subset, category=category, sort=sort)
+
+
+def filter_split_file(files):
+    input_file, output_file = files
+    start = time.time()
+    metadata = commons.read_metadata(input_file)
+
+    if filter_config['tags_subset'] is not None:
+        metadata = filter_subset(metadata, filter_config['tags_subset'])
+
+    if filter_config['category'] is not None:
+        metadata = filter_category(metadata, filter_config['category'])
+
+    if filter_config['sort']:
+        metadata = metadata.select_tracks(np.argsort(metadata.track_ids, kind='stable'))
+
+    commons.write_metadata(metadata, output_file)
+    return output_file, time.time() - start
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Filters out tags according to the subset and removes tracks with no '
                                                  'tags left')
@@ -19,6 +49,8 @@ if __name__ == '__main__':
                         help='file with list of tags subset')
     parser.add_argument('--sort', default=False, action='store_true',
                         help='sorts tracks according to track_id')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of processes to filter split files in parallel (default 1)')
 
     args = parser.parse_args()
 
@@ -27,20 +59,18 @@ if __name__ == '__main__':
         tags_subset = read_tags_file(args.subset_file)
 
     split_dirs = [split_dir for split_dir in Path(args.directory).iterdir() if split_dir.is_dir()]
-    for split_dir in split_dirs:
-        for part in PARTS:
-            input_file = split_dir / (args.input_prefix + '-' + part + '.tsv')
-            output_file = split_dir / (args.output_prefix + '-' + part + '.tsv')
-
-            tracks, tags, extra = commons.read_file(input_file)
-
-            if tags_subset is not None:
-                filter_subset(tracks, tags_subset)
-
-            if args.category is not None:
-                tracks = filter_category(tracks, tags, args.category)
-
-            if args.sort:
-                tracks = {track_id: tracks[track_id] for track_id in sorted(tracks)}
+    files = [(split_dir / (args.input_prefix + '-' + part + '.tsv'),
+              split_dir / (args.output_prefix + '-' + part + '.tsv')) for split_dir in split_dirs for part in PARTS]
 
-            commons.write_file(tracks, output_file, extra)
+    # The subset is read once and passed to every worker when it starts
+    start = time.time()
+    filter_args = (tags_subset, args.category, args.sort)
+    if args.jobs > 1:
+        with multiprocessing.Pool(args.jobs, initializer=_init_filter, initargs=filter_args) as pool:
+            for output_file, elapsed in pool.imap_unordered(filter_split_file, files):
+                print('{}: {:.2f}s'.format(output_file, elapsed))
+    else:
+        _init_filter(*filter_args)
+        for output_file, elapsed in map(filter_split_file, files):
+            print('{}: {:.2f}s'.format(output_file, elapsed))
+    print('Filtered {} files in {:.2f}s'.format(len(files), time.time() - start))
@@ -0,0 +1,36 @@
+import os
+import subprocess
+import sys
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+GROUNDTRUTH = os.path.join(SCRIPTS_DIR, '..', 'data', 'autotagging_moodtheme.tsv')
+
+
+def run_data_split(cwd, *args):
+    subprocess.check_call([sys.executable, os.path.join(SCRIPTS_DIR, 'data_split.py'), GROUNDTRUTH] + list(args),
+                          cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def read_splits(splits_dir):
+    """Contents and modification time of every file in the split-N directories"""
+    files = {}
+    for dirpath, _, names in os.walk(splits_dir):
+        for name in names:
+            if dirpath == str(splits_dir):
+                # make_split.log
+                continue
+            filename = os.path.join(dirpath, name)
+            with open(filename, 'rb') as fp:
+                files[filename] = (fp.read(), os.stat(filename).st_mtime_ns)
+    return files
+
+
+def test_update_unchanged_groundtruth(tmp_path):
+    run_data_split(tmp_path, '--trials', '40', '--seed', '1')
+    splits = read_splits(tmp_path)
+    assert len(splits) == 5 * 4
+
+    # Also a second update, in case the first one wrote anything the second one sees differently
+    for _ in range(2):
+        run_data_split(tmp_path, '--update', str(tmp_path))
+        assert read_splits(tmp_path) == splits
@@ -0,0 +1,38 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('gdown')
+pytest.importorskip('requests')
+pytest.importorskip('tqdm')
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'download'))
+import download
+
+
+@pytest.mark.parametrize('filename, folder', [
+    ('raw_30s_audio-63.tar', '63'),
+    ('raw_30s_audio-low-07.tar', '07'),
+    ('autotagging_moodtheme_melspecs-00.tar', '00'),
+    ('raw_30s_acousticbrainz-63.tar.gz', '63'),
+    ('autotagging_moodtheme_acousticbrainz-99.tar.gz', '99'),
+])
+def test_get_folder(filename, folder):
+    assert download.get_folder(filename) == folder
+
+
+def test_get_folder_unexpected_name():
+    with pytest.raises(ValueError):
+        download.get_folder('raw_30s_audio.zip')
+
+
+@pytest.mark.parametrize('data_type', ['audio', 'acousticbrainz'])
+def test_select_tars(data_type):
+    prefix = 'raw_30s/%s/' % data_type
+    sha256_tars = {path[len(prefix):]: sha256 for path, sha256 in download.read_tar_checksums().items()
+                   if path.startswith(prefix)}
+    names, tars = download.select_tars({'14/214.mp3', '63/1234563.mp3'}, sha256_tars, data_type)
+    extension = download.track_extensions[data_type]
+    assert names == {'14/214' + extension, '63/1234563' + extension}
+    assert sorted(download.get_folder(filename) for filename in tars) == ['14', '63']
@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+
+import numpy
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import melspectrograms
+
+# Maximum difference in dB between the Essentia and NumPy backends, bands near silence excepted
+TOLERANCE = 0.01
+
+
+def get_signal(length, seed=0):
+    """Noise and a sine, so that no band is near silence"""
+    rng = numpy.random.RandomState(seed)
+    t = numpy.arange(length) / 12000
+    return (0.5 * numpy.sin(2 * numpy.pi * 440 * t) + 0.1 * rng.uniform(-1, 1, length)).astype(numpy.float32)
+
+
+@pytest.mark.parametrize('center', [True, False])
+@pytest.mark.parametrize('length', [300, 511, 512, 513, 12000, 12345, 12000 * 30])
+def test_numpy_backend_matches_essentia(length, center):
+    pytest.importorskip('essentia')
+    audio = get_signal(length)
+    expected = melspectrograms.MelSpectrogram(center=center)(audio)
+    result = melspectrograms.NumpyMelSpectrogram(center=center)(audio)
+    assert result.shape == expected.shape
+    assert numpy.abs(result - expected).max() < TOLERANCE
+
+
+def test_numpy_backend_without_essentia():
+    # In a new interpreter where importing Essentia fails
+    code = ('import sys; sys.modules["essentia"] = None; import numpy, melspectrograms; '
+            'print(melspectrograms.melspectrogram(numpy.ones(12000, dtype=numpy.float32), backend="numpy").shape)')
+    output = subprocess.check_output([sys.executable, '-c', code],
+                                     cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    assert output.decode().strip() == '(96, 48)'
@@ -0,0 +1,58 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'baseline'))
+import tagger
+
+# Value that makes the model below fail, standing for a track that the model cannot process
+POISON = 999
+
+
+def model(x):
+    if (x == POISON).any():
+        raise RuntimeError('poisoned input')
+    return torch.full((x.shape[0], 50), 0.5)
+
+
+def get_tagger():
+    # A tagger without a trained model
+    t = tagger.Tagger.__new__(tagger.Tagger)
+    t.tag_list = tagger.get_tag_list('top50tags')
+    t.batch_size, t.input_length, t.hop_length, t.aggregate = 4, 64, 32, 'mean'
+    t.is_cuda = False
+    t.model = model
+    return t
+
+
+def test_mixed_batch():
+    good = np.zeros((tagger.N_BANDS, 100)).tolist()
+    requests = [
+        {'id': 1, 'mel': good},
+        {'id': 2, 'mel': [0.0] * 100},
+        {'id': 3, 'mel': np.zeros((12, 100)).tolist()},
+        {'id': 4, 'mel': [[0.0, 1.0], [2.0]]},
+        42,
+        {'id': 5, 'mel': np.full((tagger.N_BANDS, 100), np.nan).tolist()},
+        {'id': 6, 'mel': np.full((tagger.N_BANDS, 100), POISON).tolist()},
+        {'id': 7, 'mel': good},
+    ]
+    responses = get_tagger().tag(requests)
+    assert [response['id'] for response in responses] == [1, 2, 3, 4, None, 5, 6, 7]
+    for response in responses:
+        if response['id'] in (1, 7):
+            assert 'error' not in response and len(response['tags']) == 50
+        else:
+            assert 'tags' not in response and response['error']
+
+
+def test_batcher_answers_every_request():
+    batcher = tagger.MicroBatcher(get_tagger(), max_batch=4, max_wait=0.01)
+    mel = np.zeros((tagger.N_BANDS, 10)).tolist()
+    responses = [batcher.submit(request) for request in [None, [1], {'id': 1, 'mel': mel}, {'id': 2, 'mel': [1]}]]
+    results = [response.get(timeout=10) for response in responses]
+    assert [('tags' in result) for result in results] == [False, False, True, False]